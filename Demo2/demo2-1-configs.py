@@ -2,14 +2,31 @@ import os
 import sys
 from datetime import datetime
 from signal import signal, SIGINT
-from netmiko import ConnectHandler
+from netmiko import ConnectHandler, file_transfer
 from netmiko.ssh_exception import NetMikoTimeoutException, NetMikoAuthenticationException
 import getpass
 import pwinput
 from ntc_templates.parse import parse_output
 import yaml
-from jinja2 import Environment, FileSystemLoader
+from jinja2 import Environment, FileSystemLoader, TemplateNotFound, meta
 from time import sleep
+import time
+import re
+import threading
+import hashlib
+import json
+import multiprocessing
+import tempfile
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+# phasetimer is shared with the demo1 scripts in the folder above
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from phasetimer import newtimings, phase, timedconnect, reporttimings
+from profiler import profiled
+from preflight import sshhost
+from retryqueue import TRANSIENT, newretries, readydevices, retrylater, retryrounds, retryorder, closebreaker
+from loginlimit import newlimiter, waitforlogin
+from sshlogin import envlogin, sshkeys
 
 
 # Logging configs if we need to run this on
@@ -50,7 +67,91 @@ def time2pause():
 # Read commands passed from command line
 # Looking for the file that contains the Cisco devices we want to connect to
 def getarg(argv=sys.argv[1:]):
-    global datafile, config_data
+    global datafile, config_data, delta, wave, canary, gate, settle, hostvars, bulk, profile
+    argv = list(argv)
+
+    # Run under the profiler and save the profile to logs/
+    profile = False
+    if '--profile' in argv:
+        profile = True
+        argv.remove('--profile')
+
+    # Copy the config to every device as a file and merge it there, not just the ones over BULKLINES lines
+    bulk = False
+    if '--bulk' in argv:
+        bulk = True
+        argv.remove('--bulk')
+
+    # Folder of per-device YAML files, <device>.yml, laid over the shared YAML file
+    hostvars = HOSTVARS
+    if '--hostvars' in argv:
+        index = argv.index('--hostvars')
+        if index + 1 >= len(argv):
+            print('The --hostvars option needs the folder of per-device YAML files.\n\n\tExample:\tdemo2-1-configs.py --hostvars host_vars routers.txt ibgp.yml')
+            sys.exit()
+        hostvars = argv[index + 1]
+        del argv[index:index + 2]
+
+    # Roll the push out in waves of this many devices at a time, after a canary device on its own.
+    # Default of 0 pushes one device at a time like it always has.
+    wave = 0
+    if '--wave' in argv:
+        index = argv.index('--wave')
+        try:
+            wave = int(argv[index + 1])
+        except (IndexError, ValueError):
+            wave = 0
+        if wave < 1:
+            print('The --wave option needs a number of 1 or more.\n\n\tExample:\tdemo2-1-configs.py --wave 10 routers.txt ebgp.yml')
+            sys.exit()
+        del argv[index:index + 2]
+
+    # Device pushed on its own before any of the waves - default is the first device in the file
+    canary = None
+    if '--canary' in argv:
+        index = argv.index('--canary')
+        if index + 1 >= len(argv):
+            print('The --canary option needs the device to push first.\n\n\tExample:\tdemo2-1-configs.py --wave 10 --canary r1.fryguy.lab routers.txt ebgp.yml')
+            sys.exit()
+        canary = argv[index + 1]
+        del argv[index:index + 2]
+
+    # What a device has to pass after its push before it counts as done, and before the next wave starts.
+    # Defaults to established with --wave, and to none without it.
+    gate = None
+    if '--gate' in argv:
+        index = argv.index('--gate')
+        gate = argv[index + 1] if index + 1 < len(argv) else ''
+        if gate not in GATES:
+            print(f'The --gate option needs one of {", ".join(GATES)}.\n\n\tExample:\tdemo2-1-configs.py --wave 10 --gate configured routers.txt ibgp.yml')
+            sys.exit()
+        del argv[index:index + 2]
+    if gate is None:
+        gate = 'established' if wave else 'none'
+
+    # Longest time in seconds to wait for a device to pass the health gate
+    settle = GATEWAIT
+    if '--settle' in argv:
+        index = argv.index('--settle')
+        try:
+            settle = int(argv[index + 1])
+        except (IndexError, ValueError):
+            settle = -1
+        if settle < 0:
+            print('The --settle option needs a number of seconds.\n\n\tExample:\tdemo2-1-configs.py --gate established --settle 60 routers.txt ebgp.yml')
+            sys.exit()
+        del argv[index:index + 2]
+
+    if canary is not None and not wave:
+        print('The --canary option is only used with --wave.\n\n\tExample:\tdemo2-1-configs.py --wave 10 --canary r1.fryguy.lab routers.txt ebgp.yml')
+        sys.exit()
+
+    # Only push the lines the device does not already have, and skip devices that already have them all
+    delta = False
+    if '--delta' in argv:
+        delta = True
+        argv.remove('--delta')
+
     # Checking to make sure the data file was passed
     if len(argv) != 2:
         print('Please enter a command line variable containing the devices you want to connect to.\n\n\tExample:\tdemo1-1-backup.py routers.txt')
@@ -73,6 +174,13 @@ def getarg(argv=sys.argv[1:]):
 def userdata():
     global getuser, getpwd1, envuser
     envuser = getpass.getuser()
+
+    # Unattended runs take the login from the environment instead of asking - see sshlogin.py
+    login = envlogin()
+    if login:
+        getuser, getpwd1 = login
+        return(getuser, getpwd1)
+
     getuser = (input(f'Enter your username, or press enter for {envuser}: ') or envuser)
     getpwd1 = pwinput.pwinput('Please enter your password: ')
     getpwd2 = pwinput.pwinput('Please verify your password: ')
@@ -90,8 +198,120 @@ def userdata():
 
     return(getuser, getpwd1)
 
-# Perform the lldp neighbor and update the configuration.
-def pushconfig(datafile, bgpconfig, getuser, getpwd1, errorcount, successcount):
+# Commands that enter a section in config mode - the lines after them in a template apply inside that section,
+# even when the template does not indent them
+SECTIONSTART = re.compile(r'^(router |interface |ip access-list |ipv6 access-list |route-map |line |class-map |policy-map |vrf definition )')
+
+# Put a config line in the form IOS shows it in the running config, so the two can be compared.
+# Spacing and case are ignored, a 0.0.0.0 wildcard is shown as just the address, and a route-map
+# with no action or sequence is permit 10.
+def normalize(line):
+    line = ' '.join(line.split()).lower()
+    line = re.sub(r'^((?:permit|deny) \S+) 0\.0\.0\.0$', r'\1', line)
+    if re.match(r'^route-map \S+$', line):
+        line += ' permit 10'
+    return line
+
+# Read the running config into {section line: set of every line under it}, normalized
+def parserunning(running):
+    sections = {}
+    current = None
+    for line in running.splitlines():
+        if not line.strip() or line.strip().startswith('!'):
+            continue
+        if not line.startswith(' '):
+            current = sections.setdefault(normalize(line), set())
+        elif current is not None:
+            current.add(normalize(line))
+    return sections
+
+# Split the rendered config into [(section line, [lines in that section])] in the order they appear.
+# A line outside any section is its own entry with no lines under it.
+def parsedesired(config):
+    blocks = []
+    current = None
+    for line in config.splitlines():
+        if not line.strip() or line.strip().startswith('!'):
+            continue
+        if not line.startswith(' ') and SECTIONSTART.match(line):
+            current = (line.strip(), [])
+            blocks.append(current)
+        elif current is not None:
+            current[1].append(line.strip())
+        else:
+            blocks.append((line.strip(), []))
+    return blocks
+
+# Work out the lines from the rendered config that are missing from the running config.
+# A section the device does not have is sent whole, otherwise only its missing lines are sent under it.
+def configdelta(config, running):
+    runningsections = parserunning(running)
+    pushlines = []
+    for section, lines in parsedesired(config):
+        if normalize(section) not in runningsections:
+            pushlines.append(section)
+            pushlines.extend(lines)
+            continue
+        missing = [line for line in lines if normalize(line) not in runningsections[normalize(section)]]
+        if missing:
+            pushlines.append(section)
+            pushlines.extend(missing)
+    return pushlines
+
+# Health gates a device can be held to after its push
+#   established - every neighbor in the config is up and has received its prefixes
+#   configured  - every neighbor in the config shows up in show ip bgp summary, up or not
+#   none        - no check
+GATES = ('established', 'configured', 'none')
+
+# How long a device has to pass the health gate by default, and how often it is checked in that time, in seconds
+GATEWAIT = 120
+GATEPOLL = 10
+
+# Neighbor addresses the rendered config sets up - peer-group names are left out
+def configneighbors(bgpconfig):
+    return set(re.findall(r'^\s*neighbor (\d+\.\d+\.\d+\.\d+) ', bgpconfig, re.M))
+
+# Check the BGP neighbors on the device against the health gate, until it passes or gatewait seconds run out.
+# The first check is made straight away, so a device that is already healthy does not wait at all.
+# The device's own router id is left out, as a full mesh template has every router in the peer list.
+# Returns whether it passed and a line saying what was found.
+def healthgate(net_connect, neighbors, gate, gatewait=GATEWAIT):
+    if gate == 'none':
+        return True, 'no health gate'
+
+    deadline = time.monotonic() + gatewait
+    while True:
+        output = net_connect.send_command('show ip bgp summary')
+        summary = parse_output(platform='cisco_ios', command='show ip bgp summary', data=output)
+        state = {entry['bgp_neigh']: entry['state_pfxrcd'] for entry in summary}
+        expected = neighbors - {summary[0]['router_id'] if summary else None}
+
+        # An established neighbor shows the number of prefixes received in place of its state
+        if gate == 'configured':
+            waiting = sorted(neighbor for neighbor in expected if neighbor not in state)
+        else:
+            waiting = sorted(neighbor for neighbor in expected if not state.get(neighbor, '').isdigit())
+
+        if summary and not waiting:
+            return True, f'{len(expected)} BGP neighbors {gate}'
+        if time.monotonic() >= deadline:
+            if not summary:
+                return False, 'no BGP neighbors found'
+            return False, 'BGP neighbors not ' + gate + ' - ' + ', '.join(f'{neighbor} ({state.get(neighbor, "missing")})' for neighbor in waiting)
+        # Never sleep past the deadline, so the last check is made when the settle time is up and not after it
+        sleep(min(GATEPOLL, max(0, deadline - time.monotonic())))
+
+# Write an entry to the error log and count it.  Locked so entries from parallel pushes do not interleave.
+def logerror(runstate, errorentry):
+    with runstate['lock']:
+        print(errorentry)
+        runstate['errorlog'].write(errorentry)
+        runstate['errorlog'].write('-' * len(runstate['header_string']) + '\n')
+        runstate['errorcount'] += 1
+
+# Read the devices out of the data file, skipping blank lines
+def readdevices(datafile):
     # Create empty list that we can append the hostnames to
     devicelist = []
 
@@ -105,104 +325,400 @@ def pushconfig(datafile, bgpconfig, getuser, getpwd1, errorcount, successcount):
         if len(line) < 2:
             print('Looks like a blank line, skipping.\nPlease check input file.\n')
             continue
-        print(f'\nAttempting to connect to {hostconnect}...')
 
         devicelist.append(hostconnect)
 
-        # Defining connection strings
-        cisco1 = {
-            "device_type": "cisco_ios",
-            "host": hostconnect,
-            "username": getuser,
-            "password": getpwd1,
-        }
+    return devicelist
 
-        errorlog = open('logs/demo2-1-errors.log', 'w')
-        header_string = (f'! Created on {dt_string} by {envuser} \n')
-        errorlog.write(header_string)
-        errorlog.write('-' * len(header_string) + '\n')
+# Push each device its configuration, configs being {device: rendered config}.
+# With wave set, the canary device is pushed on its own first, then the rest wave devices at a time in parallel.
+# Every device in a wave has to pass the health gate before the next wave starts, and the rollout stops at the first wave that does not.
+# With delta set, only the lines the device is missing are pushed, and a device that already has them all is not pushed.
+def pushconfig(devicelist, configs, getuser, getpwd1, errorcount, successcount, delta=False, wave=0, canary=None, gate='none', settle=GATEWAIT, bulk=False):
+    if wave and canary is not None and canary not in devicelist:
+        print(f'The canary {canary} is not in the device file.\n')
+        sys.exit()
 
-        try:
-            with ConnectHandler(**cisco1) as net_connect:
-                print(f'Pushing configuration to {hostconnect}\n')
-                output = net_connect.send_config_set(bgpconfig)
-                sleep(2)
+    # Open the error log once for the whole run so one device does not overwrite another's entries
+    errorlog = open('logs/demo2-1-errors.log', 'w')
+    header_string = (f'! Created on {dt_string} by {envuser} \n')
+    errorlog.write(header_string)
+    errorlog.write('-' * len(header_string) + '\n')
+
+    # Skip the devices whose circuit breaker is open and probe the rest, so a dead one is reported now instead of after its connect timeout
+    alldevices = devicelist
+    retries = newretries()
+    devicelist, skipcount = readydevices(retries, devicelist, errorlog, header_string)
+    errorcount += skipcount
+
+    # A canary that is down cannot vouch for the rest, so the rollout does not start
+    if wave and canary is not None and canary not in devicelist:
+        stopentry = f'The canary {canary} is not available - stopping before the rollout, {len(alldevices)} devices were not pushed.\n'
+        print(stopentry)
+        errorlog.write(stopentry)
+        errorlog.close()
+        closebreaker(retries)
+        return(errorcount, successcount)
+
+    # Work out the waves - without wave set the devices are pushed one at a time and there are no waves
+    waves = []
+    if wave and devicelist:
+        if canary is None:
+            canary = devicelist[0]
+        remaining = [host for host in devicelist if host != canary]
+        waves = [[canary]] + [remaining[index:index + wave] for index in range(0, len(remaining), wave)]
+
+    # Everything the pushes share - the counters and the error log are only touched while holding the lock
+    runstate = {
+        'errorcount': errorcount,
+        'successcount': successcount,
+        'autherror': 0,
+        'errorlog': errorlog,
+        'header_string': header_string,
+        'delta': delta,
+        'gate': gate,
+        'settle': settle,
+        'bulk': bulk,
+        'lock': threading.Lock(),
+        'abort': threading.Event(),
+        'timings': newtimings('demo2-1'),
+        'retries': retries,
+        'logins': newlimiter(),
+    }
+
+    pushed = []
+    try:
+        # Devices that failed with a transient error come round again once the rest have had their turn
+        if not wave:
+            for hostconnect in retryorder(retries, devicelist):
+                pushdevice(hostconnect, configs[hostconnect], getuser, getpwd1, runstate)
+            pushed = list(devicelist)
+
+        for number, hosts in enumerate(waves):
+            label = 'canary' if number == 0 else f'wave {number} of {len(waves) - 1}'
+            print(f'\nStarting the {label} - {", ".join(hosts)}')
+
+            # Devices in the wave that failed with a transient error are pushed again before the wave is judged
+            results = {}
+            for batch in retryrounds(retries, hosts):
+                if len(batch) > 1:
+                    with ThreadPoolExecutor(max_workers=len(batch)) as pool:
+                        # Reading the results back out will raise any sys.exit from a push here in the main thread
+                        results.update(zip(batch, pool.map(lambda host: pushdevice(host, configs[host], getuser, getpwd1, runstate), batch)))
+                else:
+                    results[batch[0]] = pushdevice(batch[0], configs[batch[0]], getuser, getpwd1, runstate)
+            pushed.extend(hosts)
+
+            # Stop the rollout here if any device in the wave did not push or did not pass the health gate
+            if not all(results.values()):
+                failed = [host for host in hosts if not results[host]]
+                notpushed = [host for host in devicelist if host not in pushed]
+                stopentry = f'The {label} failed on {", ".join(failed)} - stopping the rollout, {len(notpushed)} devices were not pushed.\n'
+                print(f'\n{stopentry}')
+                errorlog.write(stopentry)
+                for item in notpushed:
+                    print('\t' + item)
+                    errorlog.write('\t' + item + '\n')
+                print('\n')
+                break
+    finally:
+        errorcount = runstate['errorcount']
+        successcount = runstate['successcount']
+        closebreaker(retries)
+
+        reporttimings(runstate['timings'], errorcount, successcount)
+        if errorcount == 0:
+            print(f'\n\nNo errors encountered.  Looks like a clean run!\nWe pushed to {successcount} devices')
+            errorlog.write(f'\n\nNo errors encountered.\n\nLooks like a clean run.\n')
+            for item in pushed:
+                print('\t' + item)
+
+        errorlog.close()
+
+    return(errorcount, successcount)
+
+# Confirm the device has finished with the config and is back at the enable prompt.
+# send_config_set sends end and reads up to the prompt that follows, so this normally only confirms it took.
+def configdone(net_connect):
+    if net_connect.check_config_mode():
+        net_connect.exit_config_mode()
+    return not net_connect.check_config_mode()
+
+# Configs with more lines than this are copied to the device as a file and merged there, instead of typed in a line at a time
+BULKLINES = 1000
+
+# Name of the file the config is copied to on the device
+BULKFILE = 'demo2-1-push.cfg'
+
+# Copy the config lines to the device over SCP and merge them into the running config with copy.
+# Needs ip scp server enable on the device.  The file is deleted again afterwards.  Returns the output of the copy.
+def bulkpush(net_connect, pushlines):
+    with tempfile.NamedTemporaryFile('w', suffix='.cfg', delete=False) as f:
+        f.write('\n'.join(pushlines) + '\n')
+    try:
+        file_system = net_connect._autodetect_fs()
+        file_transfer(net_connect, source_file=f.name, dest_file=BULKFILE, file_system=file_system, overwrite_file=True)
+    finally:
+        os.remove(f.name)
+
+    remotefile = f'{file_system}/{BULKFILE}'
+    output = net_connect.send_command(f'copy {remotefile} running-config', expect_string=r'Destination filename|#')
+    if 'Destination filename' in output:
+        output += net_connect.send_command('\n', expect_string=r'#', delay_factor=4)
+    net_connect.send_command(f'delete /force {remotefile}')
+
+    return output
+
+# Push the configuration to one device, save it, and hold it to the health gate.
+# Returns True when the device is pushed and healthy, False otherwise.
+def pushdevice(hostconnect, config, getuser, getpwd1, runstate):
+
+    # If another push hit the authentication limit, do not try any more devices
+    if runstate['abort'].is_set():
+        return False
+
+    print(f'\nAttempting to connect to {hostconnect}...')
+
+    # Defining connection strings
+    cisco1 = {
+        "device_type": "cisco_ios",
+        **sshhost(hostconnect),
+        "username": getuser,
+        "password": getpwd1,
+        **sshkeys(),
+    }
+
+    try:
+        timings = runstate['timings']
+        # Wait for a login slot, so the AAA servers are not sent more logins than they can take
+        with phase(timings, hostconnect, 'login wait'):
+            waitforlogin(runstate['logins'], hostconnect)
+        with timedconnect(timings, hostconnect, ConnectHandler, cisco1) as net_connect:
+            # Sent as a list of lines, so netmiko can match the echo of each line before sending the next
+            pushlines = config.splitlines()
+            if runstate['delta']:
+                with phase(timings, hostconnect, 'show running-config'):
+                    pushlines = configdelta(config, net_connect.send_command('show running-config'))
+
+            if not pushlines:
+                print(f'{hostconnect} already has this configuration, skipping the push and save\n')
+            else:
+                # Large configs are copied over as a file and merged on the device, so the time taken goes with
+                # the size of the config and not with the number of lines.  If the copy cannot be done, for
+                # example SCP is not enabled on the device, the config is typed in line by line instead.
+                merged = False
+                if runstate['bulk'] or len(pushlines) > BULKLINES:
+                    print(f'Copying {len(pushlines)} lines of configuration to {hostconnect}\n')
+                    try:
+                        # The SCP copy logs in to the device again, so it waits for a login slot as well
+                        with phase(timings, hostconnect, 'login wait'):
+                            waitforlogin(runstate['logins'], hostconnect)
+                        with phase(timings, hostconnect, 'copy config'):
+                            output = bulkpush(net_connect, pushlines)
+                        merged = True
+                    except Exception as err:
+                        # A transient failure is pushed again in a later round, or logged once it is out of retries.
+                        # Only a copy that cannot be done at all falls back to typing the config in.
+                        if retrylater(runstate['retries'], hostconnect, err):
+                            return False
+                        if isinstance(err, TRANSIENT):
+                            logerror(runstate, f'File copy failed - {hostconnect} - {err}\n')
+                            return False
+                        print(f'File copy to {hostconnect} failed - {err}\n...pushing line by line instead\n')
+
+                    if merged and re.search(r'^\s*%', output, re.M):
+                        logerror(runstate, f'Config merge reported errors - {hostconnect}\n{output}\n')
+                        return False
+
+                if not merged:
+                    print(f'Pushing configuration to {hostconnect}\n')
+                    with phase(timings, hostconnect, 'push config'):
+                        output = net_connect.send_config_set(pushlines)
+                        configured = configdone(net_connect)
+
+                    # Carry on as soon as the device is back out of config mode, instead of waiting a set time
+                    if not configured:
+                        logerror(runstate, f'Config mode exit failed - {hostconnect} - still at {net_connect.find_prompt()}\n')
+                        return False
 
                 # Save the configuration to the device
                 print(f'Saving configuration on {hostconnect}\n')
-                output = net_connect.send_command('write mem')
+                with phase(timings, hostconnect, 'write mem'):
+                    output = net_connect.send_command('write mem')
 
                 # Check to make sure the save was successful
                 if 'OK' in output:
-                    print('Config saved successfully\n')
+                    print(f'Config saved successfully on {hostconnect}\n')
                 else:
-                    print(f'You may need to manually save config on {hostconenct}.\n')
+                    print(f'You may need to manually save config on {hostconnect}.\n')
 
-                # Display the updated interface descriptions
-                print('Updated interface descriptions...\n')
-                showinterfaces(net_connect)
-                print('\n')
+            # Hold the device to the health gate before it counts as done
+            with phase(timings, hostconnect, 'health gate'):
+                healthy, status = healthgate(net_connect, configneighbors(config), runstate['gate'], runstate['settle'])
+            if not healthy:
+                logerror(runstate, f'Health gate failed - {hostconnect} - {status}\n')
+                return False
+            print(f'{hostconnect} is done - {status}\n')
 
-        # Error handling error for timeout, auth, etc issues.
-        except NetMikoTimeoutException as err:
-            errorentry = (f'Connettion timeout {err}')
-            errorlog.write(errorentry)
-            errorlog.write('-' * len(header_string) + '\n')
-            print(errorentry)
-            errorcount += 1
-        # This is for auth failure and will cause the program to exit so to not lock out the users account.
-        except NetMikoAuthenticationException as err:
-            errorentry = (f'Authentication failed - {hostconnect} - {err}')
-            errorlog.write(errorentry)
-            errorlog.write('-' * len(header_string) + '\n')
-            print(errorentry)
-            autherror += 1
-            if autherror >= 2:
-                print('We have had two authentication errors.\n')
-                print('\nPlease re-run and enter check password.\nPlease check log for any other errors.\n...exiting.')
-                sys.exit()
-            else:
-                print('...first authentication error, continuing...\n')
-        except ConnectionRefusedError as err:
-            errorentry = (f"Connection Refused: {err}\n")
-            print(errorentry)
-            errorlog.write(errorentry)
-            errorlog.write('-' * len(header_string) + '\n')
-            errorcount += 1
-        except TimeoutError as err:
-            errorentry = (f"Connection TimedOut: {err}\n")
-            print(errorentry)
-            errorlog.write(errorentry)
-            errorlog.write('-' * len(header_string) + '\n')
-            errorcount += 1
-        except Exception as err:
-            errorentry = (f"Connection Error: {err}\n")
-            print(errorentry)
-            errorlog.write(errorentry)
-            errorlog.write('-' * len(header_string) + '\n')
-            errorcount += 1
-            if 'Authentication to device failed' in err:
+            with runstate['lock']:
+                runstate['successcount'] += 1
+            return True
+
+    # Error handling error for timeout, auth, etc issues.
+    except NetMikoTimeoutException as err:
+        if not retrylater(runstate['retries'], hostconnect, err):
+            logerror(runstate, f'Connettion timeout {err}')
+    # This is for auth failure and will cause the program to exit so to not lock out the users account.
+    except NetMikoAuthenticationException as err:
+        logerror(runstate, f'Authentication failed - {hostconnect} - {err}')
+        with runstate['lock']:
+            runstate['autherror'] += 1
+            autherror = runstate['autherror']
+        if autherror >= 2:
+            runstate['abort'].set()
+            print('We have had two authentication errors.\n')
+            print('\nPlease re-run and enter check password.\nPlease check log for any other errors.\n...exiting.')
+            sys.exit()
+        else:
+            print('...first authentication error, continuing...\n')
+    except ConnectionRefusedError as err:
+        if not retrylater(runstate['retries'], hostconnect, err):
+            logerror(runstate, f"Connection Refused: {err}\n")
+    except TimeoutError as err:
+        if not retrylater(runstate['retries'], hostconnect, err):
+            logerror(runstate, f"Connection TimedOut: {err}\n")
+    except Exception as err:
+        if not retrylater(runstate['retries'], hostconnect, err):
+            logerror(runstate, f"Connection Error: {err}\n")
+            if 'Authentication to device failed' in str(err):
+                runstate['abort'].set()
                 print('Invalid password - exiting.')
                 sys.exit()
 
-    if errorcount >= 1:
-        print(f'We had {errorcount} errors - please check error log\n')
-    else:
-        print(f'\n\nNo errors encountered.  Looks like a clean run!')
-        errorlog.write(f'\n\nNo errors encountered.\n\nLooks like a clean run.\n')
-        for item in devicelist:
-            print('\t' + item)
+    return False
+
+# Per-device YAML files are looked for here by default
+HOSTVARS = 'host_vars'
+
+# Rendered configs are kept here, one file per set of inputs, named by the hash of the template and the variables it uses
+RENDERDIR = 'output/rendered'
 
-    errorlog.close()
+# Only start processes to render in when there are at least this many different configs to render
+RENDERPOOL = 200
 
-def generateconfig(config_data):
-    global bgpconfig
+# The compiled template, loaded once in each process that renders
+TEMPLATE = None
+
+# Compile the template.  Run once in this process, and once in each render process as it starts.
+def loadtemplate(templatename):
+    global TEMPLATE
     env = Environment(loader=FileSystemLoader('./'), trim_blocks=True, lstrip_blocks=True)
-    print(config_data['jinja2'])
-    template = env.get_template(config_data['jinja2'])
-    bgpconfig = template.render(config_data)
-    print(bgpconfig)
-    return bgpconfig
+    TEMPLATE = env.get_template(templatename)
+    return env
+
+# Render one config from its variables with the compiled template
+def renderdevice(variables):
+    return TEMPLATE.render(variables)
+
+# The source of the template and of every template it pulls in with include, import or extends, by name.
+# A name only worked out at render time cannot be followed, so then every template with the same extension is taken in.
+def templatesources(env, templatename):
+    extension = os.path.splitext(templatename)[1].lstrip('.')
+    sources = {}
+    pending = [templatename]
+    while pending:
+        name = pending.pop()
+        if name in sources:
+            continue
+        try:
+            sources[name] = env.loader.get_source(env, name)[0]
+        except TemplateNotFound:
+            # Only an include with ignore missing renders without it
+            sources[name] = ''
+            continue
+        for referenced in meta.find_referenced_templates(env.parse(sources[name])):
+            if referenced is None:
+                pending.extend(env.list_templates(extensions=[extension] if extension else None))
+            else:
+                pending.append(referenced)
+    return sources
+
+# Lay the per-device variables over the shared ones.  Dictionaries are merged key by key, anything else is replaced.
+def mergevars(shared, overlay):
+    merged = dict(shared)
+    for key, value in overlay.items():
+        if isinstance(value, dict) and isinstance(merged.get(key), dict):
+            merged[key] = mergevars(merged[key], value)
+        else:
+            merged[key] = value
+    return merged
+
+# Render the config for every device from the shared YAML and its own <hostvars>/<device>.yml, if it has one.
+# The device name is available to the template as device.  Devices whose inputs come out the same share one render,
+# and a render already in RENDERDIR from an earlier run is read back instead of rendered again.
+# Returns {device: rendered config}
+def generateconfig(config_data, devicelist, hostvars=HOSTVARS):
+    global configs
+    templatename = config_data['jinja2']
+    env = loadtemplate(templatename)
+
+    # Only the variables the template uses go into the hash, so a change to anything else does not force a new render.
+    # A template that pulls in other templates could use anything, so then all of them go in - and so does the source
+    # of every template it pulls in, so a change to one of those renders again as well.
+    sources = templatesources(env, templatename)
+    source = ''.join(f'{name}\n{sources[name]}\n' for name in sorted(sources))
+    used = meta.find_undeclared_variables(env.parse(sources[templatename]))
+    allvars = len(sources) > 1
+
+    # Work out the variables for each device, and the hash of the inputs for its render
+    renders = {}
+    devicekeys = {}
+    for hostconnect in devicelist:
+        variables = mergevars(config_data, {'device': hostconnect})
+        overlayfile = os.path.join(hostvars, hostconnect + '.yml')
+        if os.path.exists(overlayfile):
+            with open(overlayfile) as f:
+                variables = mergevars(variables, yaml.full_load(f) or {})
+
+        keyvars = variables if allvars else {key: value for key, value in variables.items() if key in used}
+        key = hashlib.sha256((source + json.dumps(keyvars, sort_keys=True, default=str)).encode()).hexdigest()
+        devicekeys[hostconnect] = key
+        renders.setdefault(key, variables)
+
+    os.makedirs(RENDERDIR, exist_ok=True)
+    rendered = {}
+    missing = []
+    for key in renders:
+        renderfile = os.path.join(RENDERDIR, key + '.cfg')
+        if os.path.exists(renderfile):
+            with open(renderfile) as f:
+                rendered[key] = f.read()
+        else:
+            missing.append(key)
+
+    # Rendering is CPU bound, so a large number of renders is spread over processes, each compiling the template once.
+    if len(missing) >= RENDERPOOL:
+        with ProcessPoolExecutor(mp_context=multiprocessing.get_context('spawn'), initializer=loadtemplate, initargs=(templatename,)) as renderpool:
+            chunksize = max(1, len(missing) // (4 * (os.cpu_count() or 1)))
+            results = list(renderpool.map(renderdevice, [renders[key] for key in missing], chunksize=chunksize))
+    else:
+        results = [renderdevice(renders[key]) for key in missing]
+
+    for key, config in zip(missing, results):
+        renderfile = os.path.join(RENDERDIR, key + '.cfg')
+        with open(renderfile + '.part', 'w') as f:
+            f.write(config)
+        os.replace(renderfile + '.part', renderfile)
+        rendered[key] = config
+
+    configs = {hostconnect: rendered[key] for hostconnect, key in devicekeys.items()}
+
+    # With one config for every device, show it like before
+    print(f'{templatename} rendered for {len(devicelist)} devices - {len(renders)} different configs, {len(missing)} rendered and {len(renders) - len(missing)} from {RENDERDIR}\n')
+    if len(renders) == 1:
+        print(next(iter(rendered.values())))
+
+    return configs
 
 if __name__ == '__main__':
     signal(SIGINT, handler)
@@ -212,8 +728,11 @@ if __name__ == '__main__':
     timeinfo()
     welcome()
     getarg()
-    generateconfig(config_data)
+    # Ask for the login before the profile starts, so the time spent typing it is not in the profile
     userdata()
-    pushconfig(datafile, bgpconfig, getuser, getpwd1, errorcount, successcount)
+    with profiled('demo2-1', profile):
+        devicelist = readdevices(datafile)
+        generateconfig(config_data, devicelist, hostvars)
+        pushconfig(devicelist, configs, getuser, getpwd1, errorcount, successcount, delta, wave, canary, gate, settle, bulk)
     #interfaceupdate(datafile, getuser, getpwd1, errorcount, successcount)
 
@@ -0,0 +1,541 @@
+# Offline benchmark for the demo scripts.
+#
+# Starts a stand-in IOS SSH server for N devices on 127.0.0.1, one port per device, and runs the main function of
+# each demo script against them - backupconfigs, getinvnetory, interfaceupdate, runcommands and pushconfig.
+# The simulated devices answer show run, show version, show ip int br, show lldp neighbors,
+# show interfaces description and show ip bgp summary.  They also take config mode and write mem, and
+# remember the descriptions and BGP neighbors pushed to them.
+#
+# Each script runs in a process of its own, so the peak memory reported is that script's alone.  For every
+# script it reports devices per second, the p50 and p99 time each device was connected for, and the peak RSS.
+# The results are saved to logs/benchmark.json.  Given an earlier results file with --baseline, any
+# script more than 10% slower is reported and the exit code is 1.
+#
+#     python benchmark.py --devices 50 --latency 20 --workers 10
+#     python benchmark.py --targets backup,inventory --baseline logs/benchmark-main.json
+import os
+import sys
+import json
+import time
+import types
+import shutil
+import socket
+import asyncio
+import tempfile
+import functools
+import subprocess
+import multiprocessing
+from datetime import datetime
+from contextlib import redirect_stdout
+
+# resource is only on Unix - on Windows the peak memory is not reported
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# asyncssh runs the simulated devices
+try:
+    import asyncssh
+except ImportError:
+    asyncssh = None
+
+
+# Where the scripts are, relative to this file
+BASEDIR = os.path.dirname(os.path.abspath(__file__))
+
+# Every script that can be benchmarked and the file it is in
+TARGETS = {
+    'backup': 'demo1-1-backup.py',
+    'inventory': 'demo1-2-inventory.py',
+    'lldp': 'demo1-3-lldp.py',
+    'commands': 'demo1-4-commands.py',
+    'commands-async': 'demo1-4-commands.py',
+    'push': 'Demo2/demo2-1-configs.py',
+}
+
+# Username and password the simulated devices accept
+BENCHUSER = 'bench'
+BENCHPASS = 'bench'
+
+# A script counts as a regression when its devices per second drops by more than this against the baseline
+REGRESSION = 0.10
+
+
+# Get the current date and time, and then format at MM/DD/YY HH:MM:SS
+def timeinfo():
+    global dt_string
+    now = datetime.now()
+    dt_string = now.strftime("%m/%d/%Y %H:%M:%S")
+    return(dt_string)
+
+# Read the options passed on the command line.  All of them are optional.
+def getarg(argv=sys.argv[1:]):
+    global options
+    argv = list(argv)
+
+    options = {
+        'devices': 20,
+        'latency': 0,
+        'config-lines': 2000,
+        'interfaces': 8,
+        'neighbors': 2,
+        'workers': 1,
+        'targets': list(TARGETS),
+        'baseline': None,
+    }
+
+    # Numeric options - devices, latency in milliseconds per command, show run length, interfaces and LLDP neighbors per device
+    for name in ('devices', 'latency', 'config-lines', 'interfaces', 'neighbors', 'workers'):
+        option = '--' + name
+        if option in argv:
+            index = argv.index(option)
+            try:
+                options[name] = int(argv[index + 1])
+            except (IndexError, ValueError):
+                options[name] = -1
+            if options[name] < 0 or (name in ('devices', 'workers') and options[name] < 1):
+                print(f'The {option} option needs a number.\n\n\tExample:\tbenchmark.py {option} 10')
+                sys.exit()
+            del argv[index:index + 2]
+
+    if '--targets' in argv:
+        index = argv.index('--targets')
+        targets = argv[index + 1].split(',') if index + 1 < len(argv) else []
+        unknown = [target for target in targets if target not in TARGETS]
+        if not targets or unknown:
+            print(f'The --targets option needs a list of {", ".join(TARGETS)}.\n\n\tExample:\tbenchmark.py --targets backup,inventory')
+            sys.exit()
+        options['targets'] = targets
+        del argv[index:index + 2]
+
+    if '--baseline' in argv:
+        index = argv.index('--baseline')
+        if index + 1 >= len(argv) or not os.path.exists(argv[index + 1]):
+            print('The --baseline option needs an earlier results file.\n\n\tExample:\tbenchmark.py --baseline logs/benchmark-main.json')
+            sys.exit()
+        options['baseline'] = argv[index + 1]
+        del argv[index:index + 2]
+
+    if argv:
+        print(f'Unknown option {argv[0]}.\n\n\tExample:\tbenchmark.py --devices 50 --latency 20 --workers 10')
+        sys.exit()
+
+    # Each LLDP neighbor link uses an interface on both ends, plus GigabitEthernet1 for management
+    options['interfaces'] = max(options['interfaces'], 2 * options['neighbors'] + 1)
+
+    return options
+
+
+# The name of each simulated device
+def devicename(index):
+    return f'bench-r{index + 1}'
+
+# Build the show run for a device from what has been pushed to it, padded out with access-list lines to config-lines
+def devicerunning(index, state, options):
+    lines = ['Building configuration...', '', f'Current configuration : {options["config-lines"] * 40} bytes', '!',
+             f'hostname {devicename(index)}', '!']
+    for number in range(1, options['interfaces'] + 1):
+        lines.append(f'interface GigabitEthernet{number}')
+        description = state['descriptions'].get(f'Gi{number}')
+        if description:
+            lines.append(f' description {description}')
+        lines.append(f' ip address 10.{index // 250}.{index % 250}.{number} 255.255.255.255')
+        lines.append('!')
+    if state['neighbors']:
+        lines.append('router bgp 65500')
+        for neighbor, remoteas in sorted(state['neighbors'].items()):
+            lines.append(f' neighbor {neighbor} remote-as {remoteas}')
+        lines.append('!')
+    for number in range(max(0, options['config-lines'] - len(lines))):
+        lines.append(f'access-list 10 permit 10.{number // 256 % 256}.{number % 256}.0 0.0.0.255')
+    lines.append('end')
+    return '\r\n'.join(lines) + '\r\n'
+
+# The LLDP neighbors of a device.  The devices are in a ring - neighbor k of device i is device i+k, on the
+# local interface Gi(k+1) and its interface Gi(neighbors+k+1), and device i+k sees the same link from its end.
+def devicelldp(index, options):
+    devices = options['devices']
+    entries = []
+    for k in range(1, options['neighbors'] + 1):
+        if k >= devices:
+            break
+        entries.append((f'Gi{k + 1}', devicename((index + k) % devices), f'Gi{options["neighbors"] + k + 1}'))
+        entries.append((f'Gi{options["neighbors"] + k + 1}', devicename((index - k) % devices), f'Gi{k + 1}'))
+    return entries
+
+# Answer one command the way IOS would
+def deviceoutput(index, command, state, options):
+    name = devicename(index)
+    if command in ('show run', 'show running-config'):
+        return devicerunning(index, state, options)
+    if command in ('show ver', 'show version'):
+        return (f'Cisco IOS XE Software, Version 16.09.03\r\nCisco IOS Software [Fuji], Virtual XE Software (X86_64_LINUX_IOSD-UNIVERSALK9-M), Version 16.9.3, RELEASE SOFTWARE (fc2)\r\n'
+                f'{name} uptime is 1 hour, 2 minutes\r\nSystem image file is "bootflash:packages.conf"\r\n'
+                f'cisco CSR1000V (VXE) processor (revision VXE) with 2392579K/3075K bytes of memory.\r\nProcessor board ID 9ZL4N6OGF{index:02d}\r\n'
+                f'Configuration register is 0x2102\r\n')
+    if command in ('show ip int br', 'show ip interface brief'):
+        lines = ['Interface              IP-Address      OK? Method Status                Protocol']
+        for number in range(1, options['interfaces'] + 1):
+            address = f'10.{index // 250}.{index % 250}.{number}'
+            lines.append(f'GigabitEthernet{number:<8} {address:<15} YES NVRAM  up                    up')
+        return '\r\n'.join(lines) + '\r\n'
+    if command in ('show lldp nei', 'show lldp neighbors'):
+        entries = devicelldp(index, options)
+        lines = ['Capability codes:', '    (R) Router, (B) Bridge, (T) Telephone, (C) DOCSIS Cable Device',
+                 '    (W) WLAN Access Point, (P) Repeater, (S) Station, (O) Other', '',
+                 'Device ID           Local Intf     Hold-time  Capability      Port ID']
+        for local, neighbor, port in entries:
+            lines.append(f'{neighbor:<19} {local:<14} 120        R               {port}')
+        lines.extend(['', f'Total entries displayed: {len(entries)}'])
+        return '\r\n'.join(lines) + '\r\n'
+    if command in ('show lldp nei detail', 'show lldp neighbors detail'):
+        entries = devicelldp(index, options)
+        lines = []
+        for local, neighbor, port in entries:
+            remote = int(neighbor.split('-r')[1]) - 1
+            lines.extend(['------------------------------------------------', f'Local Intf: {local}',
+                          f'Chassis id: 5254.00{remote // 256:02x}.{remote % 256:02x}{port[2:]:0>2}', f'Port id: {port}',
+                          f'Port Description: GigabitEthernet{port[2:]}', f'System Name: {neighbor}', '',
+                          'System Description: ', 'Cisco IOS Software [Fuji], Virtual XE Software (X86_64_LINUX_IOSD-UNIVERSALK9-M), Version 16.9.3, RELEASE SOFTWARE (fc2)', '',
+                          'Time remaining: 100 seconds', 'System Capabilities: B,R', 'Enabled Capabilities: R',
+                          'Management Addresses:', f'    IP: 10.{remote // 250}.{remote % 250}.{port[2:]}',
+                          'Auto Negotiation - not supported', 'Physical media capabilities - not advertised',
+                          'Media Attachment Unit type - not advertised', 'Vlan ID: - not advertised', ''])
+        lines.extend(['', f'Total entries displayed: {len(entries)}'])
+        return '\r\n'.join(lines) + '\r\n'
+    if command == 'show interfaces description':
+        lines = ['Interface                      Status         Protocol Description']
+        for number in range(1, options['interfaces'] + 1):
+            lines.append(f'{"Gi" + str(number):<30} up             up       {state["descriptions"].get(f"Gi{number}", "")}')
+        return '\r\n'.join(lines) + '\r\n'
+    if command == 'show ip bgp summary':
+        if not state['neighbors']:
+            return '% BGP not active\r\n'
+        lines = [f'BGP router identifier 10.255.{index // 250}.{index % 250}, local AS number 65500',
+                 'BGP table version is 1, main routing table version 1', '',
+                 'Neighbor        V           AS MsgRcvd MsgSent   TblVer  InQ OutQ Up/Down  State/PfxRcd']
+        for neighbor, remoteas in sorted(state['neighbors'].items()):
+            lines.append(f'{neighbor:<15} 4 {remoteas:>12}      10      12        1    0    0 00:01:02        3')
+        return '\r\n'.join(lines) + '\r\n'
+    if command.startswith('write'):
+        return 'Building configuration...\r\n[OK]\r\n'
+    if command.startswith('terminal') or not command:
+        return ''
+    return f'{command} output from {name}\r\n'
+
+# Apply one config mode line to the device state - interface descriptions and BGP neighbors are remembered
+def deviceconfig(line, state):
+    words = line.split()
+    if not words:
+        return
+    if words[0] == 'interface' and len(words) > 1:
+        interface = words[1]
+        state['interface'] = interface[:2] + interface.lstrip('ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz-')
+    elif words[0] in ('desc', 'description') and state.get('interface'):
+        state['descriptions'][state['interface']] = ' '.join(words[1:])
+    elif words[0] == 'neighbor' and len(words) > 3 and words[2] == 'remote-as':
+        state['neighbors'][words[1]] = words[3]
+    elif not line.startswith(' ') and words[0] not in ('exit',):
+        state['interface'] = None
+
+# One SSH session with a simulated device.  Every command waits out the latency before its output comes back.
+async def devicesession(index, states, options, process):
+    name = devicename(index)
+    state = states[index]
+    latency = options['latency'] / 1000
+    configmode = False
+    prompt = f'{name}#'
+
+    try:
+        process.stdout.write(f'\r\n{prompt}')
+        while True:
+            line = await process.stdin.readline()
+            if not line:
+                break
+            command = line.strip()
+            if command == 'exit' and not configmode:
+                break
+            if latency and command:
+                await asyncio.sleep(latency)
+
+            if command.startswith('conf'):
+                configmode = True
+                prompt = f'{name}(config)#'
+                output = 'Enter configuration commands, one per line.  End with CNTL/Z.\r\n'
+            elif configmode and command in ('end', '\x1a'):
+                configmode = False
+                prompt = f'{name}#'
+                output = ''
+            elif configmode:
+                deviceconfig(line.rstrip('\r\n'), state)
+                output = ''
+            else:
+                output = deviceoutput(index, command, state, options)
+
+            process.stdout.write(command + '\r\n')
+            # Large output goes out in pieces, like a device sending a long show run
+            for start in range(0, len(output), 4096):
+                process.stdout.write(output[start:start + 4096])
+                await asyncio.sleep(0)
+            process.stdout.write(prompt)
+    except (asyncssh.Error, ConnectionError, BrokenPipeError):
+        pass
+    process.exit(0)
+
+# The SSH server side of one simulated device.  Accepts the benchmark user, and reports how long each session was open.
+def deviceserver(index, options, results):
+    class DeviceServer(asyncssh.SSHServer):
+        def connection_made(self, conn):
+            self.started = time.monotonic()
+
+        def connection_lost(self, exc):
+            results.put((devicename(index), time.monotonic() - self.started))
+
+        def begin_auth(self, username):
+            return True
+
+        def password_auth_supported(self):
+            return True
+
+        async def validate_password(self, username, password):
+            if options['latency']:
+                await asyncio.sleep(options['latency'] / 1000)
+            return username == BENCHUSER and password == BENCHPASS
+
+    return DeviceServer()
+
+# Start a listener on 127.0.0.1 for every simulated device, and send back the port each one is on
+async def servedevices(options, ready, results):
+    hostkey = asyncssh.generate_private_key('ssh-ed25519')
+    states = [{'descriptions': {}, 'neighbors': {}, 'interface': None} for _ in range(options['devices'])]
+    ports = {}
+    for index in range(options['devices']):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.bind(('127.0.0.1', 0))
+        ports[devicename(index)] = sock.getsockname()[1]
+        await asyncssh.create_server(functools.partial(deviceserver, index, options, results), sock=sock,
+                                     server_host_keys=[hostkey], line_editor=False, backlog=100,
+                                     process_factory=functools.partial(devicesession, index, states, options))
+    ready.put(ports)
+    await asyncio.Event().wait()
+
+# Entry point of the simulated device process
+def rundevices(options, ready, results):
+    asyncio.run(servedevices(options, ready, results))
+
+
+# Load a demo script as the main module of this process, without running its __main__ block.
+# The scripts hand work to spawn process pools, which find the functions they are given by loading
+# the main script again - so the demo script has to be the main module here, not benchmark.py.
+def loadscript(scriptfile):
+    module = types.ModuleType('__mp_main__')
+    module.__file__ = scriptfile
+    sys.modules['__mp_main__'] = module
+    sys.modules['__main__'] = module
+    with open(scriptfile) as f:
+        exec(compile(f.read(), scriptfile, 'exec'), module.__dict__)
+    return module
+
+# Point a script's ConnectHandler at the simulated devices - each device name is sent to its port on 127.0.0.1
+def benchconnect(connecthandler, ports):
+    def connect(**device):
+        device = dict(device)
+        device['port'] = ports[device['host']]
+        device['host'] = '127.0.0.1'
+        return connecthandler(**device)
+    return connect
+
+# Wrap the pre-flight probe the same way, so it checks the port of the simulated device
+def benchprobe(probehost, ports):
+    def probe(hostconnect, timeout):
+        if hostconnect in ports:
+            hostconnect = f'127.0.0.1:{ports[hostconnect]}'
+        return probehost(hostconnect, timeout)
+    return probe
+
+# Peak memory of this process and of the pool processes it has finished with, in MB
+def peakrss():
+    if resource is None:
+        return None, None
+    scale = 1024 * 1024 if sys.platform == 'darwin' else 1024
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / scale)
+
+# Run one script against the simulated devices, in a work folder of its own.  Runs in a process of its own,
+# started by runbenchmark, and writes what it found to the result file.
+def runtarget(jobfile):
+    with open(jobfile) as f:
+        job = json.load(f)
+    target = job['target']
+    options = job['options']
+    ports = job['ports']
+    devicelist = list(ports)
+    workers = options['workers']
+
+    os.chdir(job['workdir'])
+    sys.path.insert(0, BASEDIR)
+    module = loadscript(os.path.join(BASEDIR, TARGETS[target]))
+    module.ConnectHandler = benchconnect(module.ConnectHandler, ports)
+    import preflight
+    preflight.probehost = benchprobe(preflight.probehost, ports)
+    module.dt_string = job['dt_string']
+    module.envuser = BENCHUSER
+    datafile = [host + '\n' for host in devicelist]
+
+    result = None
+    with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+        # The templates are rendered before the clock starts, only the push is timed
+        if target == 'push':
+            with open('ebgp.yml') as f:
+                config_data = module.yaml.full_load(f)
+            configs = module.generateconfig(config_data, devicelist)
+
+        start = time.monotonic()
+        if target == 'backup':
+            result = module.backupconfigs(datafile, BENCHUSER, BENCHPASS, 0, 0, workers)
+        elif target == 'inventory':
+            result = module.getinvnetory(datafile, BENCHUSER, BENCHPASS, 0, 0, workers)
+        elif target == 'lldp':
+            module.interfaceupdate(datafile, BENCHUSER, BENCHPASS, 0, 0)
+        elif target == 'commands':
+            with open(os.path.join(BASEDIR, 'commands.txt')) as f:
+                result = module.runcommands(datafile, f.readlines(), BENCHUSER, BENCHPASS, 0, 0)
+        elif target == 'commands-async':
+            asyncdata = [f'127.0.0.1:{ports[host]}\n' for host in devicelist]
+            with open(os.path.join(BASEDIR, 'commands.txt')) as f:
+                result = asyncio.run(module.runcommandsasync(asyncdata, f.readlines(), BENCHUSER, BENCHPASS, 0, 0, max(workers, 1)))
+        elif target == 'push':
+            wave = workers if workers > 1 else 0
+            result = module.pushconfig(devicelist, configs, BENCHUSER, BENCHPASS, 0, 0, wave=wave, gate='established' if wave else 'none')
+        seconds = time.monotonic() - start
+
+    rss, poolrss = peakrss()
+    with open(job['resultfile'], 'w') as f:
+        json.dump({'seconds': seconds, 'rss_mb': rss, 'pool_rss_mb': poolrss,
+                   'errors': result[0] if result else None}, f)
+
+# Work out a percentile of a list of numbers by nearest rank
+def percentile(values, percent):
+    if not values:
+        return None
+    values = sorted(values)
+    rank = max(1, -(-len(values) * percent // 100))
+    return values[int(rank) - 1]
+
+# Start the simulated devices, run every target against them and report on each one
+def runbenchmark(options):
+    if asyncssh is None:
+        print('The benchmark needs asyncssh for the simulated devices - pip install asyncssh')
+        sys.exit()
+
+    context = multiprocessing.get_context('spawn')
+    ready = context.Queue()
+    results = context.Queue()
+    devices = context.Process(target=rundevices, args=(options, ready, results), daemon=True)
+    devices.start()
+    ports = ready.get(timeout=120)
+
+    print(f'Benchmarking {", ".join(options["targets"])} against {options["devices"]} simulated devices, '
+          f'{options["latency"]}ms latency, {options["config-lines"]} config lines, {options["interfaces"]} interfaces, '
+          f'{options["neighbors"]} LLDP neighbors, {options["workers"]} workers\n')
+    print(f'{"target":<16}{"seconds":>9}{"devices/s":>11}{"p50 s":>9}{"p99 s":>9}{"RSS MB":>9}{"pool MB":>9}{"errors":>8}')
+
+    report = {'created': dt_string, 'options': options, 'results': {}}
+    try:
+        for target in options['targets']:
+            workdir = tempfile.mkdtemp(prefix=f'benchmark-{target}-')
+            os.makedirs(os.path.join(workdir, 'output'))
+            os.makedirs(os.path.join(workdir, 'logs'))
+            for item in ('ebgp.yml', 'ebgp.j2', 'ibgp.yml', 'ibgp.j2'):
+                shutil.copy(os.path.join(BASEDIR, 'Demo2', item), workdir)
+
+            jobfile = os.path.join(workdir, 'job.json')
+            resultfile = os.path.join(workdir, 'result.json')
+            with open(jobfile, 'w') as f:
+                json.dump({'target': target, 'options': options, 'ports': ports, 'workdir': workdir,
+                           'resultfile': resultfile, 'dt_string': dt_string}, f)
+
+            process = subprocess.run([sys.executable, os.path.abspath(__file__), '--run-target', jobfile],
+                                     stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+
+            # Give the device side a moment to see the last sessions close, then collect how long each device was connected
+            time.sleep(0.5)
+            sessions = {}
+            while not results.empty():
+                host, seconds = results.get()
+                sessions[host] = sessions.get(host, 0) + seconds
+
+            if process.returncode != 0 or not os.path.exists(resultfile):
+                print(f'{target:<16} failed - {process.stderr.strip().splitlines()[-1] if process.stderr.strip() else process.returncode}')
+                report['results'][target] = {'failed': process.stderr[-2000:]}
+                shutil.rmtree(workdir, ignore_errors=True)
+                continue
+
+            with open(resultfile) as f:
+                result = json.load(f)
+            shutil.rmtree(workdir, ignore_errors=True)
+
+            result['devices_per_second'] = options['devices'] / result['seconds'] if result['seconds'] else None
+            result['p50_seconds'] = percentile(list(sessions.values()), 50)
+            result['p99_seconds'] = percentile(list(sessions.values()), 99)
+            report['results'][target] = result
+
+            print(f'{target:<16}{result["seconds"]:>9.2f}{result["devices_per_second"]:>11.1f}'
+                  f'{formatnumber(result["p50_seconds"], 2):>9}{formatnumber(result["p99_seconds"], 2):>9}'
+                  f'{formatnumber(result["rss_mb"], 0):>9}{formatnumber(result["pool_rss_mb"], 0):>9}'
+                  f'{formatnumber(result["errors"], 0):>8}')
+    finally:
+        devices.terminate()
+
+    os.makedirs('logs', exist_ok=True)
+    with open('logs/benchmark.json', 'w') as f:
+        json.dump(report, f, indent=2)
+    print('\nResults saved to logs/benchmark.json')
+
+    regressions = 0
+    if options['baseline']:
+        regressions = comparebaseline(report, options['baseline'])
+
+    return regressions
+
+# Show a number in the results table, or - when there is not one
+def formatnumber(value, places):
+    if value is None:
+        return '-'
+    return f'{value:.{places}f}'
+
+# Compare the devices per second of each target against an earlier results file.  Returns how many got slower than REGRESSION allows.
+def comparebaseline(report, baselinefile):
+    with open(baselinefile) as f:
+        baseline = json.load(f)
+
+    print(f'\nCompared with {baselinefile} from {baseline.get("created")}')
+    regressions = 0
+    for target, result in report['results'].items():
+        before = baseline.get('results', {}).get(target, {}).get('devices_per_second')
+        after = result.get('devices_per_second')
+        if not before or not after:
+            continue
+        change = (after - before) / before
+        flag = ''
+        if change < -REGRESSION:
+            flag = '  <-- regression'
+            regressions += 1
+        print(f'\t{target:<16}{before:>9.1f} -> {after:.1f} devices/s ({change:+.0%}){flag}')
+
+    if baseline.get('options') != report['options']:
+        print('\tNote - the baseline was run with different options')
+
+    return regressions
+
+
+if __name__ == '__main__':
+    if len(sys.argv) == 3 and sys.argv[1] == '--run-target':
+        runtarget(sys.argv[2])
+        sys.exit()
+
+    timeinfo()
+    getarg()
+    if runbenchmark(options):
+        sys.exit(1)
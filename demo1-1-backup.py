@@ -6,6 +6,18 @@ from netmiko import ConnectHandler
 from netmiko.ssh_exception import NetMikoTimeoutException, NetMikoAuthenticationException
 import getpass
 import pwinput
+import re
+import threading
+import time
+import hashlib
+import gzip
+from concurrent.futures import ThreadPoolExecutor
+from phasetimer import newtimings, phase, timedconnect, reporttimings
+from profiler import profiled
+from preflight import sshhost
+from retryqueue import newretries, readydevices, retrylater, retryrounds, retryorder, closebreaker
+from loginlimit import newlimiter, waitforlogin
+from sshlogin import envlogin, sshkeys
 
 # Logging configs if we need to run this on
 def enablelogging():
@@ -45,7 +57,60 @@ def time2pause():
 # Read commands passed from command line
 # Looking for the file that contains the Cisco devices we want to connect to
 def getarg(argv=sys.argv[1:]):
-    global datafile
+    global datafile, workers, stream, store, profile, history, restore
+    argv = list(argv)
+
+    # List the backups in the store for a device, without logging in to anything
+    history = None
+    restore = None
+    if '--history' in argv:
+        index = argv.index('--history')
+        if index + 1 >= len(argv):
+            print('The --history option needs the hostname of the device.\n\n\tExample:\tdemo1-1-backup.py --history r1')
+            sys.exit()
+        history = argv[index + 1]
+        return None
+
+    # Write a backup from the store back out to output/, without logging in to anything
+    if '--restore' in argv:
+        index = argv.index('--restore')
+        if index + 2 >= len(argv):
+            print('The --restore option needs the hostname of the device and the sha256 of the backup, or the start of it.\n\n\tExample:\tdemo1-1-backup.py --restore r1 3f5a9c0e')
+            sys.exit()
+        restore = (argv[index + 1], argv[index + 2])
+        return None
+
+    # Run under the profiler and save the profile to logs/
+    profile = False
+    if '--profile' in argv:
+        profile = True
+        argv.remove('--profile')
+
+    # Keep the backups in the deduplicated store under output/store, with a history per device
+    store = False
+    if '--store' in argv:
+        store = True
+        argv.remove('--store')
+
+    # Write show run to disk as it is read instead of holding the whole config in memory
+    stream = False
+    if '--stream' in argv:
+        stream = True
+        argv.remove('--stream')
+
+    # Number of devices to back up at the same time - default is one at a time like it always has been
+    workers = 1
+    if '--workers' in argv:
+        index = argv.index('--workers')
+        try:
+            workers = int(argv[index + 1])
+        except (IndexError, ValueError):
+            workers = 0
+        if workers < 1:
+            print('The --workers option needs a number of 1 or more.\n\n\tExample:\tdemo1-1-backup.py --workers 20 routers.txt')
+            sys.exit()
+        del argv[index:index + 2]
+
     # Checking to make sure the data file was passed
     if len(argv) != 1:
         print('Please enter a command line variable containing the devices you want to connect to.\n\n\tExample:\tdemo1-1-backup.py routers.txt')
@@ -65,6 +130,13 @@ def getarg(argv=sys.argv[1:]):
 def userdata():
     global getuser, getpwd1, envuser
     envuser = getpass.getuser()
+
+    # Unattended runs take the login from the environment instead of asking - see sshlogin.py
+    login = envlogin()
+    if login:
+        getuser, getpwd1 = login
+        return(getuser, getpwd1)
+
     getuser = (input(f'Enter your username, or press enter for {envuser}: ') or envuser)
     getpwd1 = pwinput.pwinput('Please enter your password: ')
     getpwd2 = pwinput.pwinput('Please verify your password: ')
@@ -83,7 +155,8 @@ def userdata():
     return(getuser, getpwd1)
 
 # Perform the backups of the devices using the data file of devices, the username and password entered.
-def backupconfigs(datafile, getuser, getpwd1, errorcount, successcount):
+# With more than one worker the devices are backed up in parallel, each worker running backupdevice for one host.
+def backupconfigs(datafile, getuser, getpwd1, errorcount, successcount, workers=1, stream=False, store=False):
 
     # Create empty list that we can append the hostnames to
     devicelist = []
@@ -98,96 +171,348 @@ def backupconfigs(datafile, getuser, getpwd1, errorcount, successcount):
         if len(line) < 2:
             print('Looks like a blank line, skipping.\nPlease check input file.\n')
             continue
-        print(f'Attempting to connect to {hostconnect}...\n')
 
         devicelist.append(hostconnect)
 
-        # Defining connection strings
-        cisco1 = {
-            "device_type": "cisco_ios",
-            "host": hostconnect,
-            "username": getuser,
-            "password": getpwd1,
-        }
-
-        errorlog = open('logs/demo1-1-errors.log', 'w')
-        header_string = (f'Created on {dt_string} by {envuser} \n')
-        errorlog.write(header_string)
-        errorlog.write('-' * len(header_string) + '\n')
-
-        # Connect to the host specified and pull the hostname.  This will be used to create the output file.
-        command = "show run | inc hostname"
-        try:
-            with ConnectHandler(**cisco1) as net_connect:
-                output = net_connect.send_command(command)
-                hostname = output.split(' ')
-                # print(hostname[1])
-                tempvar = hostname[1].split('-')
+    # Open the error log once for the whole run so one device does not overwrite another's entries
+    errorlog = open('logs/demo1-1-errors.log', 'w')
+    header_string = (f'Created on {dt_string} by {envuser} \n')
+    errorlog.write(header_string)
+    errorlog.write('-' * len(header_string) + '\n')
+
+    # Skip the devices whose circuit breaker is open and probe the rest, so a dead one is reported now instead of after its connect timeout
+    retries = newretries()
+    devicelist, skipcount = readydevices(retries, devicelist, errorlog, header_string)
+    errorcount += skipcount
+
+    # Everything the workers share - the counters and the error log are only touched while holding the lock
+    runstate = {
+        'errorcount': errorcount,
+        'successcount': successcount,
+        'autherror': 0,
+        'errorlog': errorlog,
+        'header_string': header_string,
+        'stream': stream,
+        'store': store,
+        'unchanged': 0,
+        'lock': threading.Lock(),
+        'abort': threading.Event(),
+        'timings': newtimings('demo1-1'),
+        'retries': retries,
+        'logins': newlimiter(),
+    }
+
+    try:
+        if workers > 1:
+            print(f'Backing up {len(devicelist)} devices using {workers} workers...\n')
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                # Devices that failed with a transient error come round again once the rest have had their turn.
+                # Reading the results back out will raise any sys.exit from a worker here in the main thread
+                for hosts in retryrounds(retries, devicelist):
+                    for _ in pool.map(lambda host: backupdevice(host, getuser, getpwd1, runstate), hosts):
+                        pass
+        else:
+            for hostconnect in retryorder(retries, devicelist):
+                backupdevice(hostconnect, getuser, getpwd1, runstate)
+    finally:
+        errorcount = runstate['errorcount']
+        successcount = runstate['successcount']
+        closebreaker(retries)
+
+        if store:
+            print(f'{runstate["unchanged"]} devices were unchanged since their last backup\n')
+
+        # How long each device and each phase took, in place of just the error count
+        reporttimings(runstate['timings'], errorcount, successcount)
+
+        if errorcount == 0:
+            print(f'No errors encountered.  Looks like a clean run!\nWe backed up {successcount} devices')
+            errorlog.write(f'\n\nNo errors encountered.\n\nLooks like a clean run.\nWe backed up {successcount} devices.\n')
+            for item in devicelist:
+                print('\t' + item)
+
+        errorlog.close()
+
+    # Create the siteid.txt file for the converstion script.
+
+    return(errorcount, successcount)
+
+# Write an entry to the error log and count it.  Locked so entries from parallel workers do not interleave.
+def logerror(runstate, errorentry):
+    with runstate['lock']:
+        print(errorentry)
+        runstate['errorlog'].write(errorentry)
+        runstate['errorlog'].write('-' * len(runstate['header_string']) + '\n')
+        runstate['errorcount'] += 1
+
+# Work out the device hostname from data the session already has, instead of sending show run | inc hostname.
+# The hostname line in the collected show run is used when there is one, as the prompt can be truncated.  Falls back to the prompt netmiko captured at login.
+def gethostname(net_connect, output=''):
+    match = re.search(r'^hostname (\S+)', output, re.M)
+    if match:
+        return match.group(1)
+    return net_connect.base_prompt
+
+# Where the deduplicated backups live.  objects/ holds each distinct config once, gzipped and named by its sha256.
+# history/ has a file per device with one line per backup pointing at the object that run captured.
+STOREDIR = 'output/store'
+
+# Read a saved config file back in chunks, skipping the header lines we wrote at the top of it
+def readconfigfile(configfile, skiplines=2, chunksize=65536):
+    with open(configfile, 'rb') as f:
+        for _ in range(skiplines):
+            f.readline()
+        while True:
+            chunk = f.read(chunksize)
+            if not chunk:
+                break
+            yield chunk
+
+# Get the object the last backup of this device pointed at, or None if it has never been backed up to the store
+def lastbackup(historyfile):
+    if not os.path.exists(historyfile):
+        return None
+    lastline = None
+    with open(historyfile) as f:
+        for line in f:
+            if line.strip():
+                lastline = line
+    if lastline is None:
+        return None
+    return lastline.split('\t')[1]
+
+# The config chunks without the newlines at the end.  The streamed file ends in a newline and send_command output
+# does not, so both are stored in this one form and the same config has the same sha256 either way.
+def trimconfig(chunks):
+    held = b''
+    for chunk in chunks:
+        chunk = held + chunk
+        content = chunk.rstrip(b'\n')
+        held = chunk[len(content):]
+        if content:
+            yield content
+
+# Add a captured config to the store.  readconfig returns the config as chunks of bytes and may be called twice,
+# once to hash it and again to compress it - but only when that content is not already in the store.
+# Returns the sha256 of the config and whether it changed since the device's last backup.
+def storebackup(hostname, readconfig):
+    digest = hashlib.sha256()
+    size = 0
+    for chunk in trimconfig(readconfig()):
+        digest.update(chunk)
+        size += len(chunk)
+    digest = digest.hexdigest()
+
+    objectfile = os.path.join(STOREDIR, 'objects', digest[:2], digest + '.gz')
+    if not os.path.exists(objectfile):
+        os.makedirs(os.path.dirname(objectfile), exist_ok=True)
+        # Write under a name only this thread uses, then rename, so two devices with the same config cannot collide
+        tempfile = f'{objectfile}.{threading.get_ident()}.tmp'
+        with gzip.open(tempfile, 'wb') as f:
+            for chunk in trimconfig(readconfig()):
+                f.write(chunk)
+        os.replace(tempfile, objectfile)
+
+    historyfile = os.path.join(STOREDIR, 'history', hostname + '.log')
+    os.makedirs(os.path.dirname(historyfile), exist_ok=True)
+    changed = lastbackup(historyfile) != digest
+    with open(historyfile, 'a') as f:
+        f.write(f'{datetime.now().strftime("%Y-%m-%d %H:%M:%S")}\t{digest}\t{size}\t{"changed" if changed else "unchanged"}\n')
 
-                savefile = open('output/' + hostname[1] + '-backup.cfg', 'w')
+    return digest, changed
+
+# Read a config back out of the store by its sha256
+def readbackup(digest):
+    with gzip.open(os.path.join(STOREDIR, 'objects', digest[:2], digest + '.gz'), 'rt') as f:
+        return f.read()
+
+# The backups of a device in the store, oldest first, as (time, sha256, size, changed or unchanged)
+def readhistory(hostname):
+    historyfile = os.path.join(STOREDIR, 'history', hostname + '.log')
+    if not os.path.exists(historyfile):
+        return []
+    with open(historyfile) as f:
+        return [tuple(line.rstrip('\n').split('\t')) for line in f if line.strip()]
+
+# Print the backups of a device in the store
+def showhistory(hostname):
+    backups = readhistory(hostname)
+    if not backups:
+        print(f'There are no backups of {hostname} in {STOREDIR}.\n')
+        return
+    print(f'Backups of {hostname}, oldest first:\n')
+    for when, digest, size, status in backups:
+        print(f'\t{when}\t{digest[:12]}\t{size:>8} bytes\t{status}')
+    print('\n')
+
+# Write a backup of a device from the store to output/<hostname>-<sha>.cfg.  The sha256 can be shortened to
+# the start of it, the same as --history shows it, as long as only one backup of the device starts with it.
+def restorebackup(hostname, digest):
+    matches = sorted({entry[1] for entry in readhistory(hostname) if entry[1].startswith(digest.lower())})
+    if len(matches) != 1:
+        print(f'{len(matches)} backups of {hostname} match {digest} - see --history {hostname}.\n')
+        return None
+    restorefile = 'output/' + hostname + '-' + matches[0][:12] + '.cfg'
+    with open(restorefile, 'w') as f:
+        f.write(readbackup(matches[0]) + '\n')
+    print(f'Backup {matches[0]} of {hostname} written to {restorefile}\n')
+    return restorefile
+
+# Pager prompt and the backspaces IOS uses to erase it, in case paging was not turned off on the session
+PAGER = re.compile(r' ?--More-- ?|\x08+ *\x08*')
+
+# Send a command and write its output to savefile in chunks as it comes off the channel.
+# The echoed command, pager and trailing prompt are stripped inline, so only the current partial line is held in memory.
+# Returns the hostname if a hostname line went past, so the caller can name the file without keeping the config.
+def streamconfig(net_connect, command, savefile, timeout=120):
+    promptmatch = re.compile(re.escape(net_connect.base_prompt) + r'[>#]\s*$')
+    hostname = None
+    echoed = False
+    pending = ''
+
+    net_connect.clear_buffer()
+    net_connect.write_channel(command + net_connect.RETURN)
+    deadline = time.time() + timeout
+
+    while True:
+        chunk = net_connect.read_channel()
+        if not chunk:
+            if time.time() > deadline:
+                raise NetMikoTimeoutException(f'Timed out waiting for {command} to finish on {net_connect.host}')
+            time.sleep(0.05)
+            continue
+        deadline = time.time() + timeout
+
+        pending += chunk.replace('\r', '')
+        if '--More--' in pending:
+            net_connect.write_channel(' ')
+        pending = PAGER.sub('', pending)
+
+        # Write out every complete line and keep the partial one for the next chunk
+        lines = pending.split('\n')
+        pending = lines.pop()
+        for line in lines:
+            if not echoed:
+                echoed = True
+                if line.strip().endswith(command):
+                    continue
+            if hostname is None and line.startswith('hostname '):
+                hostname = line.split(' ')[1]
+            savefile.write(line + '\n')
+
+        # The prompt coming back on its own line means the command has finished
+        if promptmatch.match(pending):
+            return hostname
+
+# Connect to a single device, pull the running config and write it to the output folder.
+def backupdevice(hostconnect, getuser, getpwd1, runstate):
+
+    # If another worker hit the authentication limit, do not try any more devices
+    if runstate['abort'].is_set():
+        return
+
+    print(f'Attempting to connect to {hostconnect}...\n')
+
+    # Defining connection strings
+    cisco1 = {
+        "device_type": "cisco_ios",
+        **sshhost(hostconnect),
+        "username": getuser,
+        "password": getpwd1,
+        **sshkeys(),
+    }
+
+    header_string = runstate['header_string']
+    timings = runstate['timings']
+
+    # Connect to the host specified and pull the running config.  The hostname in it is used to create the output file.
+    try:
+        # Wait for a login slot, so the AAA servers are not sent more logins than they can take
+        with phase(timings, hostconnect, 'login wait'):
+            waitforlogin(runstate['logins'], hostconnect)
+        with timedconnect(timings, hostconnect, ConnectHandler, cisco1) as net_connect:
+            print(f'...running show run on {hostconnect}\n')
+            command = 'show run'
+
+            # Streaming writes to a temporary file first, as the hostname is not known until the config has been read
+            if runstate['stream']:
+                partfile = 'output/' + hostconnect.replace(':', '-') + '-backup.cfg.part'
+                savefile = open(partfile, 'w')
                 savefile.write(header_string)
                 savefile.write('-' * len(header_string) + '\n')
+                try:
+                    with phase(timings, hostconnect, command):
+                        hostname = streamconfig(net_connect, command, savefile) or gethostname(net_connect)
+                finally:
+                    savefile.close()
+                backupfile = 'output/' + hostname + '-backup.cfg'
 
-                print(f'...running show run on {hostconnect}\n')
-                command = 'show run'
-                output = net_connect.send_command(command)
-                savefile.write(output)
-                savefile.close()
-                successcount += 1
-
-        # Error handling error for timeout, auth, etc issues.
-        except NetMikoTimeoutException as err:
-            errorentry = (f'Connettion timeout {err}')
-            errorlog.write(errorentry)
-            errorlog.write('-' * len(header_string) + '\n')
-            print(errorentry)
-            errorcount += 1
-        # This is for auth failure and will cause the program to exit so to not lock out the users account.
-        except NetMikoAuthenticationException as err:
-            errorentry = (f'Authentication failed - {hostconnect} - {err}')
-            errorlog.write(errorentry)
-            errorlog.write('-' * len(header_string) + '\n')
-            print(errorentry)
-            autherror += 1
-            if autherror >= 2:
-                print('We have had two authentication errors.\n')
-                print('\nPlease re-run and enter check password.\nPlease check log for any other errors.\n...exiting.')
-                sys.exit()
+                # With the store, the latest copy in output/ is only replaced when the config actually changed
+                with phase(timings, hostconnect, 'write files'):
+                    changed = True
+                    if runstate['store']:
+                        digest, changed = storebackup(hostname, lambda: readconfigfile(partfile))
+                    if changed or not os.path.exists(backupfile):
+                        os.replace(partfile, backupfile)
+                    else:
+                        os.remove(partfile)
             else:
-                print('...first authentication error, continuing...\n')
-        except ConnectionRefusedError as err:
-            errorentry = (f"Connection Refused: {err}\n")
-            print(errorentry)
-            errorlog.write(errorentry)
-            errorlog.write('-' * len(header_string) + '\n')
-            errorcount += 1
-        except TimeoutError as err:
-            errorentry = (f"Connection TimedOut: {err}\n")
-            print(errorentry)
-            errorlog.write(errorentry)
-            errorlog.write('-' * len(header_string) + '\n')
-            errorcount += 1
-        except Exception as err:
-            errorentry = (f"Connection Error: {err}\n")
-            print(errorentry)
-            errorlog.write(errorentry)
-            errorlog.write('-' * len(header_string) + '\n')
-            errorcount += 1
-            if 'Authentication to device failed' in err:
-                print('Invalid password - exiting.')
-                sys.exit()
+                with phase(timings, hostconnect, command):
+                    output = net_connect.send_command(command)
+                hostname = gethostname(net_connect, output)
+                backupfile = 'output/' + hostname + '-backup.cfg'
 
-    if errorcount >= 1:
-        print(f'We had {errorcount} errors - please check error log\n')
-    else:
-        print(f'No errors encountered.  Looks like a clean run!\nWe backed up {successcount} devices')
-        errorlog.write(f'\n\nNo errors encountered.\n\nLooks like a clean run.\nWe backed up {successcount} devices.\n')
-        for item in devicelist:
-            print('\t' + item)
+                with phase(timings, hostconnect, 'write files'):
+                    changed = True
+                    if runstate['store']:
+                        digest, changed = storebackup(hostname, lambda: [output.encode()])
+                    if changed or not os.path.exists(backupfile):
+                        savefile = open(backupfile, 'w')
+                        savefile.write(header_string)
+                        savefile.write('-' * len(header_string) + '\n')
+                        savefile.write(output)
+                        savefile.close()
 
-    errorlog.close()
+            if runstate['store']:
+                print(f'...{hostname} is stored as {digest[:12]}\n')
+            if not changed:
+                print(f'...{hostname} is unchanged since the last backup\n')
+                with runstate['lock']:
+                    runstate['unchanged'] += 1
 
-    # Create the siteid.txt file for the converstion script.
+            with runstate['lock']:
+                runstate['successcount'] += 1
+
+    # Error handling error for timeout, auth, etc issues.
+    except NetMikoTimeoutException as err:
+        if not retrylater(runstate['retries'], hostconnect, err):
+            logerror(runstate, f'Connettion timeout {err}')
+    # This is for auth failure and will cause the program to exit so to not lock out the users account.
+    except NetMikoAuthenticationException as err:
+        logerror(runstate, f'Authentication failed - {hostconnect} - {err}')
+        with runstate['lock']:
+            runstate['autherror'] += 1
+            autherror = runstate['autherror']
+        if autherror >= 2:
+            runstate['abort'].set()
+            print('We have had two authentication errors.\n')
+            print('\nPlease re-run and enter check password.\nPlease check log for any other errors.\n...exiting.')
+            sys.exit()
+        else:
+            print('...first authentication error, continuing...\n')
+    except ConnectionRefusedError as err:
+        if not retrylater(runstate['retries'], hostconnect, err):
+            logerror(runstate, f"Connection Refused: {err}\n")
+    except TimeoutError as err:
+        if not retrylater(runstate['retries'], hostconnect, err):
+            logerror(runstate, f"Connection TimedOut: {err}\n")
+    except Exception as err:
+        if not retrylater(runstate['retries'], hostconnect, err):
+            logerror(runstate, f"Connection Error: {err}\n")
+            if 'Authentication to device failed' in str(err):
+                runstate['abort'].set()
+                print('Invalid password - exiting.')
+                sys.exit()
 
 
 if __name__ == '__main__':
@@ -198,5 +523,13 @@ if __name__ == '__main__':
     timeinfo()
     welcome()
     getarg()
+    # Looking through the store does not need a login
+    if history:
+        showhistory(history)
+        sys.exit()
+    if restore:
+        restorebackup(*restore)
+        sys.exit()
     userdata()
-    backupconfigs(datafile, getuser, getpwd1, errorcount, successcount)
+    with profiled('demo1-1', profile):
+        backupconfigs(datafile, getuser, getpwd1, errorcount, successcount, workers, stream, store)
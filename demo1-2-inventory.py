@@ -6,7 +6,17 @@ from netmiko import ConnectHandler
 from netmiko.ssh_exception import NetMikoTimeoutException, NetMikoAuthenticationException
 import getpass
 import pwinput
-from ntc_templates.parse import parse_output
+import multiprocessing
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+from phasetimer import newtimings, phase, addtime, timedconnect, timedparse, reporttimings
+from profiler import profiled
+from preflight import sshhost
+from retryqueue import newretries, readydevices, retrylater, retryrounds, closebreaker
+from loginlimit import newlimiter, waitforlogin
+from sshlogin import envlogin, sshkeys
 
 
 # Logging configs if we need to run this on
@@ -47,7 +57,34 @@ def time2pause():
 # Read commands passed from command line
 # Looking for the file that contains the Cisco devices we want to connect to
 def getarg(argv=sys.argv[1:]):
-    global datafile
+    global datafile, workers, incremental, profile
+    argv = list(argv)
+
+    # Run under the profiler and save the profile to logs/
+    profile = False
+    if '--profile' in argv:
+        profile = True
+        argv.remove('--profile')
+
+    # Only run the commands whose data is older than its freshness policy, reusing the last known values for the rest
+    incremental = False
+    if '--incremental' in argv:
+        incremental = True
+        argv.remove('--incremental')
+
+    # Number of devices to collect from at the same time
+    workers = 1
+    if '--workers' in argv:
+        index = argv.index('--workers')
+        try:
+            workers = int(argv[index + 1])
+        except (IndexError, ValueError):
+            workers = 0
+        if workers < 1:
+            print('The --workers option needs a number of 1 or more.\n\n\tExample:\tdemo1-2-inventory.py --workers 20 routers.txt')
+            sys.exit()
+        del argv[index:index + 2]
+
     # Checking to make sure the data file was passed
     if len(argv) != 1:
         print('Please enter a command line variable containing the devices you want to connect to.\n\n\tExample:\tdemo1-1-backup.py routers.txt')
@@ -67,6 +104,13 @@ def getarg(argv=sys.argv[1:]):
 def userdata():
     global getuser, getpwd1, envuser
     envuser = getpass.getuser()
+
+    # Unattended runs take the login from the environment instead of asking - see sshlogin.py
+    login = envlogin()
+    if login:
+        getuser, getpwd1 = login
+        return(getuser, getpwd1)
+
     getuser = (input(f'Enter your username, or press enter for {envuser}: ') or envuser)
     getpwd1 = pwinput.pwinput('Please enter your password: ')
     getpwd2 = pwinput.pwinput('Please verify your password: ')
@@ -84,8 +128,107 @@ def userdata():
 
     return(getuser, getpwd1)
 
-# Perform the backups of the devices using the data file of devices, the username and password entered.
-def getinvnetory(datafile, getuser, getpwd1, errorcount, successcount):
+# Work out the device hostname from data the session already has, instead of sending show run | inc hostname.
+# The hostname parsed out of show version is used when there is one, as the prompt can be truncated.  Falls back to the prompt netmiko captured at login.
+def gethostname(prompt, output=''):
+    if output and output[0].get('hostname'):
+        return output[0]['hostname']
+    return prompt
+
+# The inventory is also kept in a SQLite database, so fleet-wide questions can be answered with a query
+# instead of reading every text file back in.  One row per device, and one per interface.
+INVENTORYDB = 'output/inventory.db'
+
+# The commands the inventory is built from, and the name ntc-templates knows each one by
+INVENTORYCOMMANDS = {
+    'show version': 'show version',
+    'show ip int br': 'show ip interface brief',
+}
+
+# How long the data from each command is good for, in seconds, when running with --incremental.
+# Hardware, serial and version almost never change, interface state does.
+FRESHNESS = {
+    'show version': 24 * 60 * 60,
+    'show ip int br': 60 * 60,
+}
+
+# Open the inventory database, creating the tables and indexes the first time
+def opendatabase(dbfile=INVENTORYDB):
+    db = sqlite3.connect(dbfile)
+    db.executescript('''
+        PRAGMA journal_mode = WAL;
+        PRAGMA synchronous = NORMAL;
+        CREATE TABLE IF NOT EXISTS devices (
+            hostname TEXT PRIMARY KEY,
+            host TEXT,
+            hardware TEXT,
+            serial TEXT,
+            version TEXT,
+            uptime TEXT,
+            collected TEXT
+        );
+        CREATE TABLE IF NOT EXISTS interfaces (
+            hostname TEXT,
+            intf TEXT,
+            ipaddr TEXT,
+            status TEXT,
+            proto TEXT,
+            PRIMARY KEY (hostname, intf)
+        );
+        CREATE TABLE IF NOT EXISTS freshness (
+            host TEXT,
+            command TEXT,
+            collected REAL,
+            PRIMARY KEY (host, command)
+        );
+        CREATE INDEX IF NOT EXISTS devices_host ON devices (host);
+        CREATE INDEX IF NOT EXISTS devices_version ON devices (version);
+        CREATE INDEX IF NOT EXISTS devices_hardware ON devices (hardware);
+        CREATE INDEX IF NOT EXISTS interfaces_status ON interfaces (status, proto);
+        CREATE INDEX IF NOT EXISTS interfaces_ipaddr ON interfaces (ipaddr);
+    ''')
+    return db
+
+# Save a device and its interfaces to the database, replacing what was there from the last run.
+# Only the parts that came from a command run this time are replaced - refreshed is the list of those commands.
+# Each device is its own transaction, so a run that stops part way keeps the devices already done.
+def saveinventory(db, hostconnect, hostname, show_ver, show_int, refreshed):
+    collected = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    with db:
+        if 'show version' in refreshed:
+            for datapoint in show_ver[:1]:
+                db.execute('INSERT OR REPLACE INTO devices VALUES (?, ?, ?, ?, ?, ?, ?)',
+                           (hostname, hostconnect, (datapoint['hardware'] or [''])[0], (datapoint['serial'] or [''])[0],
+                            datapoint['version'], datapoint['uptime'], collected))
+        if 'show ip int br' in refreshed:
+            db.execute('DELETE FROM interfaces WHERE hostname = ?', (hostname,))
+            db.executemany('INSERT OR REPLACE INTO interfaces VALUES (?, ?, ?, ?, ?)',
+                           [(hostname, datapoint['intf'], datapoint['ipaddr'], datapoint['status'], datapoint['proto']) for datapoint in show_int])
+        db.executemany('INSERT OR REPLACE INTO freshness VALUES (?, ?, ?)',
+                       [(hostconnect, command, time.time()) for command in refreshed])
+
+# Work out which commands need to be run on a device - any that have never been collected or are older than their freshness policy
+def stalecommands(db, hostconnect):
+    lastrun = dict(db.execute('SELECT command, collected FROM freshness WHERE host = ?', (hostconnect,)).fetchall())
+    now = time.time()
+    return [command for command in INVENTORYCOMMANDS if now - lastrun.get(command, 0) > FRESHNESS[command]]
+
+# Get the last known inventory for a device from the database, in the same shape parse_output returns it
+def lastinventory(db, hostconnect):
+    row = db.execute('SELECT hostname, hardware, serial, version, uptime FROM devices WHERE host = ?', (hostconnect,)).fetchone()
+    if row is None:
+        return [], []
+    show_ver = [{'hostname': row[0], 'hardware': [row[1]], 'serial': [row[2]], 'version': row[3], 'uptime': row[4]}]
+    show_int = [{'intf': intf, 'ipaddr': ipaddr, 'status': status, 'proto': proto} for intf, ipaddr, status, proto in
+                db.execute('SELECT intf, ipaddr, status, proto FROM interfaces WHERE hostname = ? ORDER BY rowid', (row[0],))]
+    return show_ver, show_int
+
+# Take the inventory of the devices using the data file of devices, the username and password entered.
+# This runs as a pipeline - I/O workers only log in and collect the raw output, then close the session.
+# The raw output is handed to a process pool for the TextFSM parsing, so a slow parse never holds a
+# device session open and parsing is spread across every core.
+# With incremental set, only the commands whose data is stale are run, and a device with nothing stale is not logged in to at all.
+def getinvnetory(datafile, getuser, getpwd1, errorcount, successcount, workers=1, incremental=False):
 
     # Create empty list that we can append the hostnames to
     devicelist = []
@@ -100,116 +243,199 @@ def getinvnetory(datafile, getuser, getpwd1, errorcount, successcount):
         if len(line) < 2:
             print('Looks like a blank line, skipping.\nPlease check input file.\n')
             continue
-        print(f'\nAttempting to connect to {hostconnect}...')
 
         devicelist.append(hostconnect)
 
-        # Defining connection strings
-        cisco1 = {
-            "device_type": "cisco_ios",
-            "host": hostconnect,
-            "username": getuser,
-            "password": getpwd1,
-        }
-
-        errorlog = open('logs/demo1-2-errors.log', 'w')
-        header_string = (f'Created on {dt_string} by {envuser} \n')
-        errorlog.write(header_string)
-        errorlog.write('-' * len(header_string) + '\n')
-
-        # Connect to the host specified and pull the hostname.  This will be used to create the output file.
-        command = "show run | inc hostname"
-        try:
-            with ConnectHandler(**cisco1) as net_connect:
-                output = net_connect.send_command(command)
-                hostname = output.split(' ')
-                # print(hostname[1])
-                tempvar = hostname[1].split('-')
-
-                savefile = open('output/' + hostname[1] + '-inventory.cfg', 'w')
-                savefile.write(header_string)
-                savefile.write('-' * len(header_string) + '\n')
-
-                command = 'show version'
-                output = net_connect.send_command(command)
-                show_ver = parse_output(platform="cisco_ios", command="show version", data=output)
-                #print(show_ver)
-
-                command = 'show ip int br'
-                output = net_connect.send_command(command)
-                show_int = parse_output(platform="cisco_ios", command="show ip interface brief", data=output)
-                #print(show_int)
-
-                print(f'\n\n{hostconnect}')
-                print('-' * len(hostconnect))
-                for datapoint in show_ver:
-                    print(f'\tHardware:\t{datapoint["hardware"][0]}\n\tSerial:\t\t{datapoint["serial"][0]}\n\tVersion:\t{datapoint["version"]}\n\tUptime:\t\t{datapoint["uptime"]}')
-                    savefile.write(f'\tHardware:\t{datapoint["hardware"][0]}\n\tSerial:\t\t{datapoint["serial"][0]}\n\tVersion:\t{datapoint["version"]}\n\tUptime:\t\t{datapoint["uptime"]}\n')
-
-                print(f'\tInterfaces:')
-                savefile.write(f'\tInterfaces:\n')
-                for datapoint in show_int:
-                    print(f'\t\t\t{datapoint["intf"]:20}\t{datapoint["ipaddr"]:10}\t{datapoint["proto"]:10}')
-                    savefile.write(f'\t\t\t{datapoint["intf"]:20}\t{datapoint["ipaddr"]:10}\t{datapoint["proto"]:10}\n')
-
-                savefile.close()
-                successcount += 1
-
-
-
-        # Error handling error for timeout, auth, etc issues.
-        except NetMikoTimeoutException as err:
-            errorentry = (f'Connettion timeout {err}')
-            errorlog.write(errorentry)
-            errorlog.write('-' * len(header_string) + '\n')
-            print(errorentry)
-            errorcount += 1
-        # This is for auth failure and will cause the program to exit so to not lock out the users account.
-        except NetMikoAuthenticationException as err:
-            errorentry = (f'Authentication failed - {hostconnect} - {err}')
-            errorlog.write(errorentry)
-            errorlog.write('-' * len(header_string) + '\n')
-            print(errorentry)
-            autherror += 1
-            if autherror >= 2:
-                print('We have had two authentication errors.\n')
-                print('\nPlease re-run and enter check password.\nPlease check log for any other errors.\n...exiting.')
-                sys.exit()
-            else:
-                print('...first authentication error, continuing...\n')
-        except ConnectionRefusedError as err:
-            errorentry = (f"Connection Refused: {err}\n")
-            print(errorentry)
-            errorlog.write(errorentry)
-            errorlog.write('-' * len(header_string) + '\n')
-            errorcount += 1
-        except TimeoutError as err:
-            errorentry = (f"Connection TimedOut: {err}\n")
-            print(errorentry)
-            errorlog.write(errorentry)
-            errorlog.write('-' * len(header_string) + '\n')
-            errorcount += 1
-        except Exception as err:
-            errorentry = (f"Connection Error: {err}\n")
-            print(errorentry)
-            errorlog.write(errorentry)
-            errorlog.write('-' * len(header_string) + '\n')
-            errorcount += 1
-            if 'Authentication to device failed' in err:
+    # Open the error log once for the whole run so one device does not overwrite another's entries
+    errorlog = open('logs/demo1-2-errors.log', 'w')
+    header_string = (f'Created on {dt_string} by {envuser} \n')
+    errorlog.write(header_string)
+    errorlog.write('-' * len(header_string) + '\n')
+
+    db = opendatabase()
+
+    # Work out what to run on each device up front
+    commands = {}
+    for hostconnect in devicelist:
+        if incremental:
+            commands[hostconnect] = stalecommands(db, hostconnect)
+            if not commands[hostconnect]:
+                print(f'{hostconnect} is up to date, skipping.')
+        else:
+            commands[hostconnect] = list(INVENTORYCOMMANDS)
+
+    # Skip the devices whose circuit breaker is open and probe the rest, so a dead one is reported now instead of after its connect timeout.
+    # Only the devices with something to collect are probed - one that is up to date is not logged in to, so it does not matter if it is down.
+    retries = newretries()
+    stale, skipcount = readydevices(retries, [hostconnect for hostconnect in devicelist if commands[hostconnect]], errorlog, header_string)
+    errorcount += skipcount
+
+    # Everything the I/O workers share - the counters and the error log are only touched while holding the lock
+    runstate = {
+        'errorcount': errorcount,
+        'autherror': 0,
+        'errorlog': errorlog,
+        'header_string': header_string,
+        'lock': threading.Lock(),
+        'abort': threading.Event(),
+        'timings': newtimings('demo1-2'),
+        'retries': retries,
+        'logins': newlimiter(),
+    }
+    timings = runstate['timings']
+
+    try:
+        # spawn rather than fork, as forking while the I/O threads hold SSH sessions is not safe
+        with ProcessPoolExecutor(mp_context=multiprocessing.get_context('spawn')) as parsepool, \
+                ThreadPoolExecutor(max_workers=workers) as iopool:
+            # As each device finishes collecting, queue its output for parsing.  Devices that failed with a transient
+            # error are collected again once the rest have had their turn, while the parsing carries on.
+            parsing = []
+            for hosts in retryrounds(retries, stale):
+                collecting = [iopool.submit(collectdevice, hostconnect, commands[hostconnect], getuser, getpwd1, runstate)
+                              for hostconnect in hosts]
+
+                for future in as_completed(collecting):
+                    rawdata = future.result()
+                    if rawdata is None:
+                        continue
+                    parsed = {}
+                    for command in rawdata['commands']:
+                        parsed[command] = parsepool.submit(timedparse, platform="cisco_ios", command=INVENTORYCOMMANDS[command], data=rawdata[command])
+                    parsing.append((rawdata, parsed))
+
+            for rawdata, parsed in parsing:
+                try:
+                    # Anything not collected this run comes from the last known record
+                    if len(parsed) < len(INVENTORYCOMMANDS):
+                        show_ver, show_int = lastinventory(db, rawdata['hostconnect'])
+                    # The parse time comes back from the pool with the parsed output
+                    hostconnect = rawdata['hostconnect']
+                    if 'show version' in parsed:
+                        show_ver, seconds = parsed['show version'].result()
+                        addtime(timings, hostconnect, 'parse', seconds)
+                    if 'show ip int br' in parsed:
+                        show_int, seconds = parsed['show ip int br'].result()
+                        addtime(timings, hostconnect, 'parse', seconds)
+                    with phase(timings, hostconnect, 'write files'):
+                        writeinventory(rawdata, show_ver, show_int, header_string, db)
+                    successcount += 1
+                except Exception as err:
+                    logerror(runstate, f"Parse Error: {rawdata['hostconnect']} - {err}\n")
+    finally:
+        errorcount = runstate['errorcount']
+        closebreaker(retries)
+
+        # How long each device and each phase took, in place of just the error count
+        reporttimings(timings, errorcount, successcount)
+
+        if errorcount == 0:
+            print(f'\n\nNo errors encountered.  Looks like a clean run!')
+            errorlog.write(f'\n\nNo errors encountered.\n\nLooks like a clean run.\n')
+            for item in devicelist:
+                print('\t' + item)
+
+        errorlog.close()
+        db.close()
+
+    # Create the siteid.txt file for the converstion script.
+
+    return(errorcount, successcount)
+
+# Write an entry to the error log and count it.  Locked so entries from parallel workers do not interleave.
+def logerror(runstate, errorentry):
+    with runstate['lock']:
+        print(errorentry)
+        runstate['errorlog'].write(errorentry)
+        runstate['errorlog'].write('-' * len(runstate['header_string']) + '\n')
+        runstate['errorcount'] += 1
+
+# Connect to a single device and collect the raw output of the commands for the inventory.  No parsing is done here,
+# so the session is closed as soon as the commands have run.  Returns None if the device could not be collected.
+def collectdevice(hostconnect, commands, getuser, getpwd1, runstate):
+
+    # If another worker hit the authentication limit, do not try any more devices
+    if runstate['abort'].is_set():
+        return None
+
+    print(f'\nAttempting to connect to {hostconnect}...')
+
+    # Defining connection strings
+    cisco1 = {
+        "device_type": "cisco_ios",
+        **sshhost(hostconnect),
+        "username": getuser,
+        "password": getpwd1,
+        **sshkeys(),
+    }
+
+    try:
+        # Wait for a login slot, so the AAA servers are not sent more logins than they can take
+        with phase(runstate['timings'], hostconnect, 'login wait'):
+            waitforlogin(runstate['logins'], hostconnect)
+        with timedconnect(runstate['timings'], hostconnect, ConnectHandler, cisco1) as net_connect:
+            rawdata = {'hostconnect': hostconnect, 'prompt': net_connect.base_prompt, 'commands': commands}
+            for command in commands:
+                with phase(runstate['timings'], hostconnect, command):
+                    rawdata[command] = net_connect.send_command(command)
+            return rawdata
+
+    # Error handling error for timeout, auth, etc issues.
+    except NetMikoTimeoutException as err:
+        if not retrylater(runstate['retries'], hostconnect, err):
+            logerror(runstate, f'Connettion timeout {err}')
+    # This is for auth failure and will cause the program to exit so to not lock out the users account.
+    except NetMikoAuthenticationException as err:
+        logerror(runstate, f'Authentication failed - {hostconnect} - {err}')
+        with runstate['lock']:
+            runstate['autherror'] += 1
+            autherror = runstate['autherror']
+        if autherror >= 2:
+            runstate['abort'].set()
+            print('We have had two authentication errors.\n')
+            print('\nPlease re-run and enter check password.\nPlease check log for any other errors.\n...exiting.')
+            sys.exit()
+        else:
+            print('...first authentication error, continuing...\n')
+    except ConnectionRefusedError as err:
+        if not retrylater(runstate['retries'], hostconnect, err):
+            logerror(runstate, f"Connection Refused: {err}\n")
+    except TimeoutError as err:
+        if not retrylater(runstate['retries'], hostconnect, err):
+            logerror(runstate, f"Connection TimedOut: {err}\n")
+    except Exception as err:
+        if not retrylater(runstate['retries'], hostconnect, err):
+            logerror(runstate, f"Connection Error: {err}\n")
+            if 'Authentication to device failed' in str(err):
+                runstate['abort'].set()
                 print('Invalid password - exiting.')
                 sys.exit()
 
-    if errorcount >= 1:
-        print(f'We had {errorcount} errors - please check error log\n')
-    else:
-        print(f'\n\nNo errors encountered.  Looks like a clean run!')
-        errorlog.write(f'\n\nNo errors encountered.\n\nLooks like a clean run.\n')
-        for item in devicelist:
-            print('\t' + item)
+    return None
 
-    errorlog.close()
+# Print the parsed inventory for a device and save it to the output folder, named by the device hostname, and to the database
+def writeinventory(rawdata, show_ver, show_int, header_string, db):
+    hostconnect = rawdata['hostconnect']
+    hostname = gethostname(rawdata['prompt'], show_ver)
+    saveinventory(db, hostconnect, hostname, show_ver, show_int, rawdata['commands'])
 
-    # Create the siteid.txt file for the converstion script.
+    savefile = open('output/' + hostname + '-inventory.cfg', 'w')
+    savefile.write(header_string)
+    savefile.write('-' * len(header_string) + '\n')
+
+    print(f'\n\n{hostconnect}')
+    print('-' * len(hostconnect))
+    for datapoint in show_ver:
+        print(f'\tHardware:\t{datapoint["hardware"][0]}\n\tSerial:\t\t{datapoint["serial"][0]}\n\tVersion:\t{datapoint["version"]}\n\tUptime:\t\t{datapoint["uptime"]}')
+        savefile.write(f'\tHardware:\t{datapoint["hardware"][0]}\n\tSerial:\t\t{datapoint["serial"][0]}\n\tVersion:\t{datapoint["version"]}\n\tUptime:\t\t{datapoint["uptime"]}\n')
+
+    print(f'\tInterfaces:')
+    savefile.write(f'\tInterfaces:\n')
+    for datapoint in show_int:
+        print(f'\t\t\t{datapoint["intf"]:20}\t{datapoint["ipaddr"]:10}\t{datapoint["proto"]:10}')
+        savefile.write(f'\t\t\t{datapoint["intf"]:20}\t{datapoint["ipaddr"]:10}\t{datapoint["proto"]:10}\n')
+
+    savefile.close()
 
 
 if __name__ == '__main__':
@@ -221,4 +447,5 @@ if __name__ == '__main__':
     welcome()
     getarg()
     userdata()
-    getinvnetory(datafile, getuser, getpwd1, errorcount, successcount)
+    with profiled('demo1-2', profile):
+        getinvnetory(datafile, getuser, getpwd1, errorcount, successcount, workers, incremental)
@@ -6,7 +6,19 @@ from netmiko import ConnectHandler
 from netmiko.ssh_exception import NetMikoTimeoutException, NetMikoAuthenticationException
 import getpass
 import pwinput
-from ntc_templates.parse import parse_output
+from parsecache import parse_output
+import multiprocessing
+import re
+import json
+import threading
+import xml.etree.ElementTree as ET
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from phasetimer import newtimings, phase, timedconnect, reporttimings
+from profiler import profiled
+from preflight import sshhost
+from retryqueue import newretries, readydevices, retrylater, retryrounds, retryorder, closebreaker
+from loginlimit import newlimiter, waitforlogin
+from sshlogin import envlogin, sshkeys
 
 
 # Logging configs if we need to run this on
@@ -47,7 +59,53 @@ def time2pause():
 # Read commands passed from command line
 # Looking for the file that contains the Cisco devices we want to connect to
 def getarg(argv=sys.argv[1:]):
-    global datafile
+    global datafile, workers, topology, delta, profile, keepsessions
+    argv = list(argv)
+
+    # Run under the profiler and save the profile to logs/
+    profile = False
+    if '--profile' in argv:
+        profile = True
+        argv.remove('--profile')
+
+    # Only push the descriptions that are different from what the device already has
+    delta = False
+    if '--delta' in argv:
+        delta = True
+        argv.remove('--delta')
+
+    # Build the LLDP topology for every device first and generate the descriptions from it
+    topology = False
+    if '--topology' in argv:
+        topology = True
+        argv.remove('--topology')
+
+    # Number of devices to work on at the same time in --topology mode
+    workers = TOPOLOGYWORKERS
+    if '--workers' in argv:
+        index = argv.index('--workers')
+        try:
+            workers = int(argv[index + 1])
+        except (IndexError, ValueError):
+            workers = 0
+        if workers < 1:
+            print('The --workers option needs a number of 1 or more.\n\n\tExample:\tdemo1-3-lldp.py --topology --workers 20 routers.txt')
+            sys.exit()
+        del argv[index:index + 2]
+
+    # Most sessions to keep open in --topology mode between collecting LLDP and pushing, 0 to log in again for every push
+    keepsessions = KEEPSESSIONS
+    if '--keep' in argv:
+        index = argv.index('--keep')
+        try:
+            keepsessions = int(argv[index + 1])
+        except (IndexError, ValueError):
+            keepsessions = -1
+        if keepsessions < 0:
+            print('The --keep option needs a number of 0 or more.\n\n\tExample:\tdemo1-3-lldp.py --topology --keep 50 routers.txt')
+            sys.exit()
+        del argv[index:index + 2]
+
     # Checking to make sure the data file was passed
     if len(argv) != 1:
         print('Please enter a command line variable containing the devices you want to connect to.\n\n\tExample:\tdemo1-1-backup.py routers.txt')
@@ -67,6 +125,13 @@ def getarg(argv=sys.argv[1:]):
 def userdata():
     global getuser, getpwd1, envuser
     envuser = getpass.getuser()
+
+    # Unattended runs take the login from the environment instead of asking - see sshlogin.py
+    login = envlogin()
+    if login:
+        getuser, getpwd1 = login
+        return(getuser, getpwd1)
+
     getuser = (input(f'Enter your username, or press enter for {envuser}: ') or envuser)
     getpwd1 = pwinput.pwinput('Please enter your password: ')
     getpwd2 = pwinput.pwinput('Please verify your password: ')
@@ -84,12 +149,45 @@ def userdata():
 
     return(getuser, getpwd1)
 
+# Work out the device hostname from the prompt netmiko captured at login, instead of sending show run | inc hostname.
+def gethostname(net_connect):
+    return net_connect.base_prompt
+
+# Save the configuration to the device and check to make sure the save was successful
+def saveconfig(net_connect, hostconnect):
+    print(f'Saving configuration on {hostconnect}\n')
+    output = net_connect.send_command('write mem')
+    if 'OK' in output:
+        print(f'Config saved successfully on {hostconnect}\n')
+    else:
+        print(f'You may need to manually save config on {hostconnect}.\n')
+
+# Work out the config needed to get the interfaces to their expected descriptions, given the parsed
+# show interfaces description from the device.  Only interfaces whose description is different are included.
+def descriptiondelta(show_int, expected):
+    current = {shortname(datapoint['port']): datapoint['descrip'] for datapoint in show_int}
+    pushlines = []
+    for interface, description in expected.items():
+        if current.get(interface) != description:
+            pushlines.extend([f'interface {interface}', f' description {description}'])
+    return pushlines
+
 # Perform the lldp neighbor and update the configuration.
-def interfaceupdate(datafile, getuser, getpwd1, errorcount, successcount):
+# With delta set, only descriptions that differ from the device are pushed, and the save is skipped when nothing changed.
+def interfaceupdate(datafile, getuser, getpwd1, errorcount, successcount, delta=False):
 
     # Create empty list that we can append the hostnames to
     devicelist = []
 
+    # The show interfaces parsing is done in a process pool, so the session is not held open while it runs.
+    # spawn rather than fork, as forking while an SSH session is open is not safe.
+    parsepool = ProcessPoolExecutor(mp_context=multiprocessing.get_context('spawn'))
+
+    timings = newtimings('demo1-3')
+
+    # Two authentication failures stop the run, so the account is not locked out
+    autherror = 0
+
     # Read the input data file, assign it to connecthost
     # Strip off any carriage returns that may have ben read in as well
     for line in datafile:
@@ -100,83 +198,116 @@ def interfaceupdate(datafile, getuser, getpwd1, errorcount, successcount):
         if len(line) < 2:
             print('Looks like a blank line, skipping.\nPlease check input file.\n')
             continue
-        print(f'\nAttempting to connect to {hostconnect}...')
 
         devicelist.append(hostconnect)
 
+    # Open the error log once for the whole run, the pre-flight check writes to it before any device is worked on
+    errorlog = open('logs/demo1-3-errors.log', 'w')
+    header_string = (f'! Created on {dt_string} by {envuser} \n')
+    errorlog.write(header_string)
+    errorlog.write('-' * len(header_string) + '\n')
+
+    # Skip the devices whose circuit breaker is open and probe the rest, so a dead one is reported now instead of after its connect timeout
+    retries = newretries()
+    logins = newlimiter()
+    devicelist, skipcount = readydevices(retries, devicelist, errorlog, header_string)
+    errorcount += skipcount
+
+    # Devices that failed with a transient error come round again once the rest have had their turn
+    for hostconnect in retryorder(retries, devicelist):
+        print(f'\nAttempting to connect to {hostconnect}...')
+
         # Defining connection strings
         cisco1 = {
             "device_type": "cisco_ios",
-            "host": hostconnect,
+            **sshhost(hostconnect),
             "username": getuser,
             "password": getpwd1,
+            **sshkeys(),
         }
 
-        errorlog = open('logs/demo1-3-errors.log', 'w')
-        header_string = (f'! Created on {dt_string} by {envuser} \n')
-        errorlog.write(header_string)
-        errorlog.write('-' * len(header_string) + '\n')
-
-        # Connect to the host specified and pull the hostname.  This will be used to create the output file.
-        command = "show run | inc hostname"
+        # Connect to the host specified and take the hostname from the prompt.  This will be used to create the output file.
         try:
-            with ConnectHandler(**cisco1) as net_connect:
-                output = net_connect.send_command(command)
-                hostname = output.split(' ')
-                # print(hostname[1])
-                tempvar = hostname[1].split('-')
+            # Wait for a login slot, so the AAA servers are not sent more logins than they can take
+            with phase(timings, hostconnect, 'login wait'):
+                waitforlogin(logins, hostconnect)
+            with timedconnect(timings, hostconnect, ConnectHandler, cisco1) as net_connect:
+                hostname = gethostname(net_connect)
 
-                savefile = open('output/' + hostname[1] + '-lldp.cfg', 'w')
+                savefile = open('output/' + hostname + '-lldp.cfg', 'w')
                 savefile.write(header_string)
                 savefile.write('! ' + '-' * len(header_string) + '\n')
 
-                # Call out to get the interface descriptions currently configured and report them to user
-                print('Current interface descriptions...\n')
-                showinterfaces(net_connect)
+                # Call out to get the interface descriptions currently configured - they are reported once the session is closed
+                with phase(timings, hostconnect, 'show interfaces description'):
+                    beforeint = showinterfaces(net_connect, parsepool)
 
                 # Run the show lldp neighbor command
                 command = 'show lldp nei'
-                output = net_connect.send_command(command)
-                show_lldp = parse_output(platform="cisco_ios", command="show lldp neighbors", data=output)
+                with phase(timings, hostconnect, command):
+                    output = net_connect.send_command(command)
+                with phase(timings, hostconnect, 'parse'):
+                    show_lldp = parse_output(platform="cisco_ios", command="show lldp neighbors", data=output)
                 #print(show_lldp)
 
                 # Parse the output of show lldp and identify local interface, neighbor description, and neigbhbor interface and then write this to a file for a config
+                # Keep track of the interfaces touched and the description they should end up with, for the check after the push
+                expected = {}
                 for lldpnei in show_lldp:
-                    savefile.write(f'\ninterface {lldpnei["local_interface"]}\n desc Connection to {lldpnei["neighbor"]} - {lldpnei["neighbor_interface"]}\n')
+                    description = f'Connection to {lldpnei["neighbor"]} - {lldpnei["neighbor_interface"]}'
+                    savefile.write(f'\ninterface {lldpnei["local_interface"]}\n desc {description}\n')
+                    expected[shortname(lldpnei["local_interface"])] = description
 
                 savefile.close()
 
                 # Set the  config file so that we can push it
-                configfile = 'output/' + hostname[1] + '-lldp.cfg'
-
-                successcount += 1
-
-                # Push the config to the device
-                print(f'Pushing configuration to {hostconnect}\n')
-                output = net_connect.send_config_from_file(configfile)
-
-                # Save the configuration to the device
-                print(f'Saving configuration on {hostconnect}\n')
-                output = net_connect.send_command('write mem')
-
-                # Check to make sure the save was successful
-                if 'OK' in output:
-                    print('Config saved successfully\n')
+                configfile = 'output/' + hostname + '-lldp.cfg'
+
+                # In delta mode only the interfaces whose description is different are sent.  If none are,
+                # there is nothing to push or save, and the before output is the after output.
+                if delta:
+                    pushlines = descriptiondelta(beforeint.result(), expected)
+                    if not pushlines:
+                        print(f'{hostconnect} already has these descriptions, skipping the push and save\n')
+                        afterint = beforeint
+                    else:
+                        print(f'Pushing {len(pushlines) // 2} changed descriptions to {hostconnect}\n')
+                        with phase(timings, hostconnect, 'push config'):
+                            output = net_connect.send_config_set(pushlines)
+                        with phase(timings, hostconnect, 'write mem'):
+                            saveconfig(net_connect, hostconnect)
+                        with phase(timings, hostconnect, 'show interfaces description'):
+                            afterint = showinterfaces(net_connect, parsepool)
                 else:
-                    print(f'You may need to manually save config on {hostconenct}.\n')
-
-                # Display the updated interface descriptions
-                print('Updated interface descriptions...\n')
-                showinterfaces(net_connect)
-                print('\n')
+                    # Push the config to the device
+                    print(f'Pushing configuration to {hostconnect}\n')
+                    with phase(timings, hostconnect, 'push config'):
+                        output = net_connect.send_config_from_file(configfile)
+                    with phase(timings, hostconnect, 'write mem'):
+                        saveconfig(net_connect, hostconnect)
+
+                    # Get the updated interface descriptions
+                    with phase(timings, hostconnect, 'show interfaces description'):
+                        afterint = showinterfaces(net_connect, parsepool)
+
+            # Session is closed, now report the before and check the interfaces we changed from the parse pool
+            print('Current interface descriptions...\n')
+            printinterfaces(beforeint.result())
+            print('Updated interface descriptions...\n')
+            verifyinterfaces(afterint.result(), expected)
+            print('\n')
+
+            # Counted once the device is done, so a device that is tried again is not counted twice
+            successcount += 1
 
         # Error handling error for timeout, auth, etc issues.
         except NetMikoTimeoutException as err:
-            errorentry = (f'Connettion timeout {err}')
-            errorlog.write(errorentry)
-            errorlog.write('-' * len(header_string) + '\n')
-            print(errorentry)
-            errorcount += 1
+            if not retrylater(retries, hostconnect, err):
+                errorentry = (f'Connettion timeout {err}')
+                errorlog.write(errorentry)
+                errorlog.write('-' * len(header_string) + '\n')
+                print(errorentry)
+                errorcount += 1
         # This is for auth failure and will cause the program to exit so to not lock out the users account.
         except NetMikoAuthenticationException as err:
             errorentry = (f'Authentication failed - {hostconnect} - {err}')
@@ -191,59 +322,416 @@ def interfaceupdate(datafile, getuser, getpwd1, errorcount, successcount):
             else:
                 print('...first authentication error, continuing...\n')
         except ConnectionRefusedError as err:
-            errorentry = (f"Connection Refused: {err}\n")
-            print(errorentry)
-            errorlog.write(errorentry)
-            errorlog.write('-' * len(header_string) + '\n')
-            errorcount += 1
+            if not retrylater(retries, hostconnect, err):
+                errorentry = (f"Connection Refused: {err}\n")
+                print(errorentry)
+                errorlog.write(errorentry)
+                errorlog.write('-' * len(header_string) + '\n')
+                errorcount += 1
         except TimeoutError as err:
-            errorentry = (f"Connection TimedOut: {err}\n")
-            print(errorentry)
-            errorlog.write(errorentry)
-            errorlog.write('-' * len(header_string) + '\n')
-            errorcount += 1
+            if not retrylater(retries, hostconnect, err):
+                errorentry = (f"Connection TimedOut: {err}\n")
+                print(errorentry)
+                errorlog.write(errorentry)
+                errorlog.write('-' * len(header_string) + '\n')
+                errorcount += 1
         except Exception as err:
-            errorentry = (f"Connection Error: {err}\n")
-            print(errorentry)
-            errorlog.write(errorentry)
-            errorlog.write('-' * len(header_string) + '\n')
-            errorcount += 1
-            if 'Authentication to device failed' in err:
-                print('Invalid password - exiting.')
-                sys.exit()
-
-    if errorcount >= 1:
-        print(f'We had {errorcount} errors - please check error log\n')
-    else:
+            if not retrylater(retries, hostconnect, err):
+                errorentry = (f"Connection Error: {err}\n")
+                print(errorentry)
+                errorlog.write(errorentry)
+                errorlog.write('-' * len(header_string) + '\n')
+                errorcount += 1
+                if 'Authentication to device failed' in str(err):
+                    print('Invalid password - exiting.')
+                    sys.exit()
+
+    closebreaker(retries)
+
+    # How long each device and each phase took, in place of just the error count
+    reporttimings(timings, errorcount, successcount)
+
+    if errorcount == 0:
         print(f'\n\nNo errors encountered.  Looks like a clean run!')
         errorlog.write(f'\n\nNo errors encountered.\n\nLooks like a clean run.\n')
         for item in devicelist:
             print('\t' + item)
 
     errorlog.close()
+    parsepool.shutdown()
 
 # Since we are using this a few times, set aside in its own function area
-def showinterfaces(net_connect):
-    command = 'show interfaces'
+# Collects show interfaces description and hands it to the parse pool, returning the future for the parsed output.
+# This only has the interface, status and description, so it is far smaller to transfer and parse than show interfaces.
+def showinterfaces(net_connect, parsepool):
+    command = 'show interfaces description'
     output = net_connect.send_command(command)
-    show_int = parse_output(platform="cisco_ios", command="show interfaces", data=output)
+    return parsepool.submit(parse_output, platform="cisco_ios", command="show interfaces description", data=output)
+
+# Shorten an interface name the way IOS does in show lldp and show interfaces description - GigabitEthernet1 to Gi1
+def shortname(interface):
+    match = re.match(r'^([A-Za-z]+)-?([A-Za-z]*)(.*)$', interface)
+    if not match:
+        return interface
+    return match.group(1)[:2] + match.group(3)
+
+# Display the interface and description from the parsed show interfaces description
+def printinterfaces(show_int):
     # print(show_int)
     # Parse the output and display the interface and description
     for datapoint in show_int:
         # If the interface is Loopback0, skip it
-        if datapoint['interface'] == 'Loopback0':
+        if shortname(datapoint['port']) == 'Lo0':
             pass
 
         # If the interface has no description ( lenght of 0 ) set the description to No description
-        elif len(datapoint['description']) == 0:
-            datapoint['description'] = "No description"
-            print(f'\tInterface {datapoint["interface"]} has a description of {datapoint["description"]}')
+        elif len(datapoint['descrip']) == 0:
+            datapoint['descrip'] = "No description"
+            print(f'\tInterface {datapoint["port"]} has a description of {datapoint["descrip"]}')
 
         # Print the current description on the interface
         else:
-            print(f'\tInterface {datapoint["interface"]} has a description of {datapoint["description"]}')
+            print(f'\tInterface {datapoint["port"]} has a description of {datapoint["descrip"]}')
+
+    print('\n')
+
+# Check only the interfaces the LLDP config touched have the description we pushed.  Returns the number that do not.
+def verifyinterfaces(show_int, expected):
+    current = {shortname(datapoint['port']): datapoint['descrip'] for datapoint in show_int}
+    mismatches = 0
+    for interface, description in expected.items():
+        if current.get(interface) == description:
+            print(f'\tInterface {interface} has a description of {description}')
+        else:
+            print(f'\tInterface {interface} should have a description of {description} but has {current.get(interface) or "No description"}')
+            mismatches += 1
 
     print('\n')
+    return mismatches
+
+
+# Most sessions --topology keeps open from collecting LLDP to pushing the descriptions.  Every kept session is an
+# idle vty line on the device and a transport thread here, so past this the devices log out and log in again to push.
+KEEPSESSIONS = 100
+
+# Devices --topology works on at the same time when --workers is not given
+TOPOLOGYWORKERS = 20
+
+# Build the LLDP topology for the whole fabric and update every device's descriptions from it.
+# LLDP is collected from all devices at the same time, both directions of each link are merged into one
+# graph, the graph is exported to output/topology.json and output/topology.graphml, and the description
+# config for every device is rendered from the graph and pushed.
+def topologyupdate(datafile, getuser, getpwd1, errorcount, successcount, workers=TOPOLOGYWORKERS, delta=False, keepsessions=KEEPSESSIONS):
+
+    # Create empty list that we can append the hostnames to
+    devicelist = []
+
+    for line in datafile:
+        # Checking for a blank line as it would have two characters
+        if len(line) < 2:
+            print('Looks like a blank line, skipping.\nPlease check input file.\n')
+            continue
+        devicelist.append(line.strip())
+
+    # Open the error log once for the whole run so one device does not overwrite another's entries
+    errorlog = open('logs/demo1-3-errors.log', 'w')
+    header_string = (f'! Created on {dt_string} by {envuser} \n')
+    errorlog.write(header_string)
+    errorlog.write('-' * len(header_string) + '\n')
+
+    # Skip the devices whose circuit breaker is open and probe the rest, so a dead one is reported now instead of after its connect timeout
+    retries = newretries()
+    devicelist, skipcount = readydevices(retries, devicelist, errorlog, header_string)
+    errorcount += skipcount
+
+    # Everything the workers share - the counters and the error log are only touched while holding the lock
+    runstate = {
+        'errorcount': errorcount,
+        'successcount': successcount,
+        'autherror': 0,
+        'errorlog': errorlog,
+        'header_string': header_string,
+        'lock': threading.Lock(),
+        'abort': threading.Event(),
+        'timings': newtimings('demo1-3'),
+        'retries': retries,
+        'logins': newlimiter(),
+        'sessions': {},
+        'keepopen': keepsessions,
+    }
+
+    try:
+        # Collect LLDP from every device at the same time
+        print(f'Collecting LLDP neighbors from {len(devicelist)} devices...\n')
+        # Devices that failed with a transient error come round again once the rest have had their turn
+        collected = []
+        with ThreadPoolExecutor(max_workers=workers) as iopool:
+            for hosts in retryrounds(retries, devicelist):
+                collected.extend(iopool.map(lambda host: runonhost(host, getuser, getpwd1, runstate, collectlldp), hosts))
+
+        graph = buildtopology([item for item in collected if item])
+        exporttopology(graph)
+        print(f'Topology has {len(graph["nodes"])} devices and {len(graph["links"])} links - saved to output/topology.json and output/topology.graphml\n')
+        for warning in checktopology(graph):
+            print(f'\tWarning: {warning}')
+
+        # Render every device's description config from the graph, then push them all - on the sessions kept
+        # open from collecting LLDP where there is one, and logging out of each device once it is pushed
+        configs = renderdescriptions(graph, header_string)
+        runstate['keepopen'] = 0
+        with ThreadPoolExecutor(max_workers=workers) as iopool:
+            for hosts in retryrounds(retries, list(configs)):
+                for pushed in iopool.map(lambda host: runonhost(host, getuser, getpwd1, runstate, pushdescriptions, configs[host], delta), hosts):
+                    if pushed:
+                        runstate['successcount'] += 1
+    finally:
+        # Log out of any device that had nothing to push
+        for net_connect in runstate['sessions'].values():
+            net_connect.disconnect()
+
+        errorcount = runstate['errorcount']
+        successcount = runstate['successcount']
+        closebreaker(retries)
+
+        # How long each device and each phase took, in place of just the error count
+        reporttimings(runstate['timings'], errorcount, successcount)
+
+        if errorcount == 0:
+            print(f'\n\nNo errors encountered.  Looks like a clean run!')
+            errorlog.write(f'\n\nNo errors encountered.\n\nLooks like a clean run.\n')
+            for item in devicelist:
+                print('\t' + item)
+
+        errorlog.close()
+
+    return(errorcount, successcount)
+
+# Write an entry to the error log and count it.  Locked so entries from parallel workers do not interleave.
+def logerror(runstate, errorentry):
+    with runstate['lock']:
+        print(errorentry)
+        runstate['errorlog'].write(errorentry)
+        runstate['errorlog'].write('-' * len(runstate['header_string']) + '\n')
+        runstate['errorcount'] += 1
+
+# Connect to a device and run task(net_connect, hostconnect, *args) on it, with the usual error handling.
+# The task is timed as a phase named after it.  Returns whatever the task returns, or None if the device could not be reached.
+def runonhost(hostconnect, getuser, getpwd1, runstate, task, *args):
+
+    # If another worker hit the authentication limit, do not try any more devices
+    if runstate['abort'].is_set():
+        return None
+
+    # Defining connection strings
+    cisco1 = {
+        "device_type": "cisco_ios",
+        **sshhost(hostconnect),
+        "username": getuser,
+        "password": getpwd1,
+        **sshkeys(),
+    }
+
+    try:
+        # A session kept open by the task before on this device is used again, so it does not log in a second time.
+        # One the device has closed in the meantime, such as on its vty exec-timeout, is let go and logged in again.
+        with runstate['lock']:
+            net_connect = runstate['sessions'].pop(hostconnect, None)
+        if net_connect is not None and not net_connect.is_alive():
+            net_connect.disconnect()
+            net_connect = None
+
+        if net_connect is None:
+            print(f'\nAttempting to connect to {hostconnect}...')
+            # Wait for a login slot, so the AAA servers are not sent more logins than they can take
+            with phase(runstate['timings'], hostconnect, 'login wait'):
+                waitforlogin(runstate['logins'], hostconnect)
+            net_connect = timedconnect(runstate['timings'], hostconnect, ConnectHandler, cisco1)
+
+        try:
+            with phase(runstate['timings'], hostconnect, task.__name__):
+                result = task(net_connect, hostconnect, *args)
+        except BaseException:
+            net_connect.disconnect()
+            raise
+
+        # Keep the session open for the next task while there is room for it, otherwise log out
+        with runstate['lock']:
+            keep = len(runstate['sessions']) < runstate['keepopen']
+            if keep:
+                runstate['sessions'][hostconnect] = net_connect
+        if not keep:
+            net_connect.disconnect()
+        return result
+
+    # Error handling error for timeout, auth, etc issues.
+    except NetMikoTimeoutException as err:
+        if not retrylater(runstate['retries'], hostconnect, err):
+            logerror(runstate, f'Connettion timeout {err}')
+    # This is for auth failure and will cause the program to exit so to not lock out the users account.
+    except NetMikoAuthenticationException as err:
+        logerror(runstate, f'Authentication failed - {hostconnect} - {err}')
+        with runstate['lock']:
+            runstate['autherror'] += 1
+            autherror = runstate['autherror']
+        if autherror >= 2:
+            runstate['abort'].set()
+            print('We have had two authentication errors.\n')
+            print('\nPlease re-run and enter check password.\nPlease check log for any other errors.\n...exiting.')
+            sys.exit()
+        else:
+            print('...first authentication error, continuing...\n')
+    except ConnectionRefusedError as err:
+        if not retrylater(runstate['retries'], hostconnect, err):
+            logerror(runstate, f"Connection Refused: {err}\n")
+    except TimeoutError as err:
+        if not retrylater(runstate['retries'], hostconnect, err):
+            logerror(runstate, f"Connection TimedOut: {err}\n")
+    except Exception as err:
+        if not retrylater(runstate['retries'], hostconnect, err):
+            logerror(runstate, f"Connection Error: {err}\n")
+            if 'Authentication to device failed' in str(err):
+                runstate['abort'].set()
+                print('Invalid password - exiting.')
+                sys.exit()
+
+    return None
+
+# Collect and parse show lldp neighbors detail for one device.  show lldp neighbors cuts the Device ID at 20
+# characters, so longer names would not match the devices in the graph - the detail has the full system name.
+# The neighbor interface is the Port id, the Port Description is the neighbor's own interface description.
+def collectlldp(net_connect, hostconnect):
+    output = net_connect.send_command('show lldp neighbors detail')
+    show_lldp = parse_output(platform="cisco_ios", command="show lldp neighbors detail", data=output)
+    neighbors = [{'local_interface': lldpnei['local_interface'], 'neighbor': lldpnei['neighbor'] or lldpnei['chassis_id'],
+                  'neighbor_interface': lldpnei['neighbor_port_id']} for lldpnei in show_lldp]
+    return {'host': hostconnect, 'hostname': gethostname(net_connect), 'neighbors': neighbors}
+
+# LLDP reports the neighbor's system name, which can have the domain on it - r2.fryguy.lab is the device r2
+def nodename(name):
+    return name.split('.')[0].lower()
+
+# Build the topology graph from the LLDP collected from every device.
+# graph['nodes'] is indexed by device name, with the host we connect to and an index of local interface to link.
+# graph['links'] is indexed by the two (device, interface) ends of the link sorted, so the link reported by
+# each side ends up as the same entry.  Each end also keeps how its own side reported the neighbor.
+def buildtopology(collected):
+    graph = {'nodes': {}, 'links': {}, 'conflicts': []}
+
+    def addnode(name, host=None):
+        node = graph['nodes'].setdefault(name, {'host': None, 'interfaces': {}})
+        if host:
+            node['host'] = host
+        return node
+
+    for device in collected:
+        addnode(nodename(device['hostname']), device['host'])
+
+    for device in collected:
+        local = nodename(device['hostname'])
+        for lldpnei in device['neighbors']:
+            remote = nodename(lldpnei['neighbor'])
+            localend = (local, shortname(lldpnei['local_interface']))
+            remoteend = (remote, shortname(lldpnei['neighbor_interface']))
+            linkid = tuple(sorted([localend, remoteend]))
+
+            # A local interface already linked somewhere else is a shared segment or a cabling problem - keep the first
+            existing = graph['nodes'][local]['interfaces'].get(localend[1])
+            if existing is not None and existing != linkid:
+                graph['conflicts'].append(f'{local} {localend[1]} reports {remote} {remoteend[1]}, already linked to {existing}')
+                continue
+
+            link = graph['links'].setdefault(linkid, {'ends': {}, 'seenfrom': []})
+            link['seenfrom'].append(local)
+            link['ends'][localend] = {'neighbor': lldpnei['neighbor'], 'neighbor_interface': lldpnei['neighbor_interface']}
+            link['ends'].setdefault(remoteend, None)
+
+            addnode(local)['interfaces'][localend[1]] = linkid
+            addnode(remote)['interfaces'].setdefault(remoteend[1], linkid)
+
+    return graph
+
+# Things in the graph worth a look - links only one side reports when both are ours, and conflicting reports
+def checktopology(graph):
+    warnings = list(graph['conflicts'])
+    for linkid, link in graph['links'].items():
+        for name, interface in linkid:
+            if graph['nodes'][name]['host'] and name not in link['seenfrom']:
+                warnings.append(f'{linkid[0][0]} {linkid[0][1]} - {linkid[1][0]} {linkid[1][1]} is not seen by LLDP on {name}')
+    return warnings
+
+# Save the graph as JSON and as GraphML, so it can be loaded into other tools or drawn
+def exporttopology(graph, jsonfile='output/topology.json', graphmlfile='output/topology.graphml'):
+    nodes = [{'name': name, 'host': node['host']} for name, node in sorted(graph['nodes'].items())]
+    links = [{'source': a[0], 'source_interface': a[1], 'target': b[0], 'target_interface': b[1], 'seenfrom': sorted(set(link['seenfrom']))}
+             for (a, b), link in sorted(graph['links'].items())]
+    with open(jsonfile, 'w') as f:
+        json.dump({'nodes': nodes, 'links': links}, f, indent=2)
+
+    root = ET.Element('graphml', xmlns='http://graphml.graphdrawing.org/xmlns')
+    for keyid, target, name in [('host', 'node', 'host'), ('sif', 'edge', 'source_interface'), ('tif', 'edge', 'target_interface')]:
+        ET.SubElement(root, 'key', {'id': keyid, 'for': target, 'attr.name': name, 'attr.type': 'string'})
+    graphml = ET.SubElement(root, 'graph', id='lldp', edgedefault='undirected')
+    for node in nodes:
+        element = ET.SubElement(graphml, 'node', id=node['name'])
+        ET.SubElement(element, 'data', key='host').text = node['host'] or ''
+    for link in links:
+        element = ET.SubElement(graphml, 'edge', source=link['source'], target=link['target'])
+        ET.SubElement(element, 'data', key='sif').text = link['source_interface']
+        ET.SubElement(element, 'data', key='tif').text = link['target_interface']
+    ET.ElementTree(root).write(graphmlfile, encoding='utf-8', xml_declaration=True)
+
+# Render the description config for every device we can connect to from the graph, one file per device.
+# An end that did not report the link itself still gets a description, from what the other end reported.
+# Returns {host: (configfile, expected)} for the devices that have something to push, expected being the
+# description each interface should end up with.
+def renderdescriptions(graph, header_string):
+    configs = {}
+    for name, node in sorted(graph['nodes'].items()):
+        if not node['host'] or not node['interfaces']:
+            continue
+
+        configfile = 'output/' + name + '-lldp.cfg'
+        expected = {}
+        savefile = open(configfile, 'w')
+        savefile.write(header_string)
+        savefile.write('! ' + '-' * len(header_string) + '\n')
+        for interface, linkid in sorted(node['interfaces'].items()):
+            link = graph['links'][linkid]
+            localend = (name, interface)
+            remoteend = linkid[1] if linkid[0] == localend else linkid[0]
+            reported = link['ends'].get(localend)
+            if reported:
+                description = f'Connection to {reported["neighbor"]} - {reported["neighbor_interface"]}'
+            else:
+                description = f'Connection to {remoteend[0]} - {remoteend[1]}'
+            savefile.write(f'\ninterface {interface}\n desc {description}\n')
+            expected[interface] = description
+        savefile.close()
+
+        configs[node['host']] = (configfile, expected)
+
+    return configs
+
+# Push a rendered description config to a device and save it.  With delta set, only the descriptions that
+# differ from the device are sent, and nothing is pushed or saved if they all match.
+def pushdescriptions(net_connect, hostconnect, config, delta=False):
+    configfile, expected = config
+
+    if delta:
+        output = net_connect.send_command('show interfaces description')
+        show_int = parse_output(platform="cisco_ios", command="show interfaces description", data=output)
+        pushlines = descriptiondelta(show_int, expected)
+        if not pushlines:
+            print(f'{hostconnect} already has these descriptions, skipping the push and save\n')
+            return configfile
+        print(f'Pushing {len(pushlines) // 2} changed descriptions to {hostconnect}\n')
+        net_connect.send_config_set(pushlines)
+    else:
+        print(f'Pushing configuration to {hostconnect}\n')
+        net_connect.send_config_from_file(configfile)
+
+    saveconfig(net_connect, hostconnect)
+    return configfile
 
 
 if __name__ == '__main__':
@@ -255,5 +743,9 @@ if __name__ == '__main__':
     welcome()
     getarg()
     userdata()
-    interfaceupdate(datafile, getuser, getpwd1, errorcount, successcount)
+    with profiled('demo1-3', profile):
+        if topology:
+            topologyupdate(datafile, getuser, getpwd1, errorcount, successcount, workers, delta, keepsessions)
+        else:
+            interfaceupdate(datafile, getuser, getpwd1, errorcount, successcount, delta)
 
@@ -7,6 +7,20 @@ from netmiko.ssh_exception import NetMikoTimeoutException, NetMikoAuthentication
 import getpass
 import pwinput
 from ntc_templates.parse import parse_output
+import asyncio
+import re
+from phasetimer import newtimings, phase, timedconnect, reporttimings
+from profiler import profiled
+from preflight import splithost, sshhost
+from retryqueue import TRANSIENT, newretries, readydevices, retrylater, retryrounds, retryorder, closebreaker
+from loginlimit import newlimiter, waitforlogin, waitforloginasync
+from sshlogin import envlogin, sshkeys, asynckeys
+
+# asyncssh is only needed for the --async mode, so the script still runs without it installed
+try:
+    import asyncssh
+except ImportError:
+    asyncssh = None
 
 
 # Logging configs if we need to run this on
@@ -48,7 +62,32 @@ def time2pause():
 # Looking for the file that contains the Cisco devices we want to connect to
 # Looking for the file that contains the commands that we want to run against the host devices
 def getarg(argv=sys.argv[1:]):
-    global datafile,commandfile
+    global datafile,commandfile,asyncmode,sessions,profile
+    argv = list(argv)
+
+    # Run under the profiler and save the profile to logs/
+    profile = False
+    if '--profile' in argv:
+        profile = True
+        argv.remove('--profile')
+
+    # Optional --async mode runs every device on one event loop, --sessions limits how many are open at once
+    asyncmode = False
+    sessions = 500
+    if '--async' in argv:
+        asyncmode = True
+        argv.remove('--async')
+    if '--sessions' in argv:
+        index = argv.index('--sessions')
+        try:
+            sessions = int(argv[index + 1])
+        except (IndexError, ValueError):
+            sessions = 0
+        if sessions < 1:
+            print('The --sessions option needs a number of 1 or more.\n\n\tExample:\tdemo1-4-commands.py --async --sessions 1000 routers.txt commands.txt\n')
+            sys.exit()
+        del argv[index:index + 2]
+
     # Checking to make sure the data file was passed
     if len(argv) != 2:
         print('Please enter a command line variable containing the devices you want to connect to.\n\n\tExample:\tdemo1-4-commands.py routers.txt commands.txt\n')
@@ -77,6 +116,13 @@ def userdata():
     # that for default, unless a username is entered
     global getuser, getpwd1, envuser
     envuser = getpass.getuser()
+
+    # Unattended runs take the login from the environment instead of asking - see sshlogin.py
+    login = envlogin()
+    if login:
+        getuser, getpwd1 = login
+        return(getuser, getpwd1)
+
     getuser = (input(f'Enter your username, or press enter for {envuser}: ') or envuser)
 
     # We are getting the password here, twice - so that we can verify that it matches
@@ -96,68 +142,334 @@ def userdata():
 
     return(getuser, getpwd1)
 
-# Perform the lldp neighbor and update the configuration.
+# Run the list of commands against each device, one SSH session per device for the whole command list.
 def runcommands(datafile, commandfile, getuser, getpwd1, errorcount, successcount):
 
     # Create empty list that we can append the hostnames to and another for the commands
     devicelist = []
     commandlist = []
 
-    # Adding the commands to a list, easier to iterate over, yet not really necessary when I think about it
+    # Adding the commands to a list, skipping any blank lines so we do not send an empty command
     for item in commandfile:
-        commandlist.append(item)
+        if len(item.strip()) == 0:
+            continue
+        commandlist.append(item.strip())
+
+    # Creating an error-log in case of problems, once for the whole run
+    errorlog = open('logs/demo1-4-errors.log', 'w')
+    header_string = (f'! Created on {dt_string} by {envuser} \n')
+    errorlog.write(header_string)
+    errorlog.write('-' * len(header_string) + '\n')
+
+    # Time each phase of the work on every device, reported at the end of the run
+    timings = newtimings('demo1-4')
 
     # Read the input data file, assign it to connecthost
     # Strip off any carriage returns that may have ben read in as well
     for line in datafile:
         # Strip carriage return from line read fromfile
         hostconnect = line.strip()
-        hostoutput = open('output/' + hostconnect + '.log', 'w')
 
         # Checking for a blank line as it would have two characters
         if len(line) < 2:
             print('Looks like a blank line, skipping.\nPlease check input file.\n')
             continue
-        print(f'\nAttempting to connect to {hostconnect}...')
 
         devicelist.append(hostconnect)
 
+    # Skip the devices whose circuit breaker is open and probe the rest, so a dead one is reported now instead of after its connect timeout
+    retries = newretries()
+    logins = newlimiter()
+    devicelist, skipcount = readydevices(retries, devicelist, errorlog, header_string)
+    errorcount += skipcount
+
+    # Two authentication failures stop the run, so the account is not locked out
+    autherror = 0
+
+    # Devices that failed with a transient error come round again once the rest have had their turn
+    for hostconnect in retryorder(retries, devicelist):
+        print(f'\nAttempting to connect to {hostconnect}...')
+
         # Defining connection strings
         cisco1 = {
             "device_type": "cisco_ios",
-            "host": hostconnect,
+            **sshhost(hostconnect),
             "username": getuser,
             "password": getpwd1,
+            **sshkeys(),
         }
 
-        # Creating an error-log in case of problems
-        errorlog = open('output\demo1-4-errors.log', 'w')
-        header_string = (f'! Created on {dt_string} by {envuser} \n')
-        errorlog.write(header_string)
-        errorlog.write('-' * len(header_string) + '\n')
+        # Any :port is turned into -port so it stays a valid file name
+        hostoutput = open('output/' + hostconnect.replace(':', '-') + '.log', 'w')
         hostoutput.write(header_string)
         hostoutput.write('-' * len(header_string) + '\n')
 
-        # Iterating over commands and sending them to the device via the runcommand section
-        for item in commandfile:
-            try:
-                with ConnectHandler(**cisco1) as net_connect:
-                    runcommand(net_connect, item, hostoutput)
+        # Log in once and send every command back to back on the same session
+        try:
+            # Wait for a login slot, so the AAA servers are not sent more logins than they can take
+            with phase(timings, hostconnect, 'login wait'):
+                waitforlogin(logins, hostconnect)
+            with timedconnect(timings, hostconnect, ConnectHandler, cisco1) as net_connect:
+                for item in commandlist:
+                    with phase(timings, hostconnect, item):
+                        runcommand(net_connect, item, hostoutput)
+            successcount += 1
 
-            except Exception as err:
+        # This is for auth failure and will cause the program to exit so to not lock out the users account.
+        except NetMikoAuthenticationException as err:
+            errorentry = (f'Authentication failed - {hostconnect} - {err}\n')
+            errorlog.write(errorentry)
+            errorlog.write('-' * len(header_string) + '\n')
+            print(errorentry)
+            autherror += 1
+            if autherror >= 2:
+                print('We have had two authentication errors.\n')
+                print('\nPlease re-run and enter check password.\nPlease check log for any other errors.\n...exiting.')
+                sys.exit()
+            else:
+                print('...first authentication error, continuing...\n')
+        except Exception as err:
+            if not retrylater(retries, hostconnect, err):
+                errorentry = (f"Connection Error: {hostconnect} - {err}\n")
                 print(errorentry)
                 errorlog.write(errorentry)
                 errorlog.write('-' * len(header_string) + '\n')
+                errorcount += 1
+                if 'Authentication to device failed' in str(err):
+                    print('Invalid password - exiting.')
+                    sys.exit()
+
+        hostoutput.close()
+
+    closebreaker(retries)
+    reporttimings(timings, errorcount, successcount)
+    if errorcount == 0:
+        print(f'\n\nNo errors encountered.  Looks like a clean run!')
+        errorlog.write(f'\n\nNo errors encountered.\n\nLooks like a clean run.\n')
+        for item in devicelist:
+            print('\t' + item)
+
+    errorlog.close()
+
+    return(errorcount, successcount)
 
 
 # Since we are using this a few times, set aside in its own function area
 # This will use the open connection to the device and send the command that is iterated over
+# The output is flushed to the host log as soon as it comes back, so a long command list can be watched as it runs
 def runcommand(net_connect, command, hostoutput):
     print(f'Running {command}\n')
     hostoutput.write('\n' + '-' * 20 + '\n')
-    hostoutput.write(command)
+    hostoutput.write(command + '\n')
     output = net_connect.send_command(command)
     hostoutput.write(output)
+    hostoutput.flush()
+
+# Read from the shell until the device prompt comes back.  Returns everything read, including the prompt.
+async def readuntilprompt(process, prompt, timeout):
+    buffer = ''
+    while not buffer.rstrip().endswith(prompt):
+        chunk = await asyncio.wait_for(process.stdout.read(65536), timeout)
+        if not chunk:
+            raise ConnectionResetError(f'Session closed while waiting for {prompt}')
+        buffer += chunk
+    return buffer
+
+# Find the device prompt after login, the same way netmiko does - send a return and look at the last line
+async def findprompt(process, timeout):
+    process.stdin.write('\n')
+    buffer = ''
+    while True:
+        chunk = await asyncio.wait_for(process.stdout.read(65536), timeout)
+        if not chunk:
+            raise ConnectionResetError('Session closed before a prompt was found')
+        buffer += chunk
+        lastline = buffer.replace('\r', '').rstrip().split('\n')[-1].strip()
+        if re.match(r'^\S+[>#]$', lastline):
+            return lastline
+
+# Run the list of commands against every device on one asyncio event loop.
+# Each device is a coroutine, so thousands of sessions can be open without a thread for each one.
+async def runcommandsasync(datafile, commandfile, getuser, getpwd1, errorcount, successcount, sessions=500, timeout=60):
+
+    if asyncssh is None:
+        print('The --async mode needs the asyncssh package.  Please run pip install asyncssh and try again.\n')
+        sys.exit()
+
+    # Create empty list that we can append the hostnames to and another for the commands
+    devicelist = []
+    commandlist = []
+
+    for item in commandfile:
+        if len(item.strip()) == 0:
+            continue
+        commandlist.append(item.strip())
+
+    for line in datafile:
+        if len(line) < 2:
+            print('Looks like a blank line, skipping.\nPlease check input file.\n')
+            continue
+        devicelist.append(line.strip())
+
+    # Creating an error-log in case of problems, once for the whole run
+    errorlog = open('logs/demo1-4-errors.log', 'w')
+    header_string = (f'! Created on {dt_string} by {envuser} \n')
+    errorlog.write(header_string)
+    errorlog.write('-' * len(header_string) + '\n')
+
+    # Skip the devices whose circuit breaker is open and probe the rest, so a dead one is reported now instead of after its connect timeout
+    retries = newretries()
+    devicelist, skipcount = readydevices(retries, devicelist, errorlog, header_string)
+    errorcount += skipcount
+
+    # Everything runs on one thread, so the counters can be shared without a lock
+    runstate = {
+        'errorcount': errorcount,
+        'successcount': successcount,
+        'errorlog': errorlog,
+        'header_string': header_string,
+        'semaphore': asyncio.Semaphore(sessions),
+        'timings': newtimings('demo1-4'),
+        'retries': retries,
+        'logins': newlimiter(),
+        'autherror': 0,
+        'abort': False,
+        'loggedin': False,
+        'firstlogin': asyncio.Lock(),
+    }
+
+    print(f'Running {len(commandlist)} commands on {len(devicelist)} devices, up to {sessions} sessions at a time...\n')
+    # Devices that failed with a transient error come round again once the rest have had their turn.  The wait
+    # for the next round blocks the loop, which is fine as nothing else is running on it between rounds.
+    for hosts in retryrounds(retries, devicelist):
+        await asyncio.gather(*[runhostasync(hostconnect, commandlist, getuser, getpwd1, runstate, timeout) for hostconnect in hosts])
+        if runstate['abort']:
+            break
+
+    errorcount = runstate['errorcount']
+    successcount = runstate['successcount']
+    closebreaker(retries)
+
+    reporttimings(runstate['timings'], errorcount, successcount)
+    if errorcount == 0:
+        print(f'\n\nNo errors encountered.  Looks like a clean run!')
+        errorlog.write(f'\n\nNo errors encountered.\n\nLooks like a clean run.\n')
+        for item in devicelist:
+            print('\t' + item)
+
+    errorlog.close()
+
+    return(errorcount, successcount)
+
+# Log in to one device once there is a login slot for it.  Returns None if the run was stopped while it waited.
+async def connectasync(host, port, hostconnect, getuser, getpwd1, runstate, timeout):
+    if runstate['abort']:
+        return None
+    print(f'\nAttempting to connect to {hostconnect}...')
+
+    # Wait for a login slot, so the AAA servers are not sent more logins than they can take
+    with phase(runstate['timings'], hostconnect, 'login wait'):
+        await waitforloginasync(runstate['logins'], hostconnect)
+    with phase(runstate['timings'], hostconnect, 'ssh login'):
+        conn = await asyncssh.connect(host, port=port, username=getuser, password=getpwd1, known_hosts=None,
+                                      connect_timeout=timeout, **asynckeys())
+    runstate['loggedin'] = True
+    return conn
+
+# Until one login has worked the devices log in one at a time, so a wrong password fails on two devices and
+# stops the run, instead of failing on every device at once.  After that they log in side by side.
+async def loginasync(host, port, hostconnect, getuser, getpwd1, runstate, timeout):
+    if not runstate['loggedin']:
+        async with runstate['firstlogin']:
+            if not runstate['loggedin']:
+                return await connectasync(host, port, hostconnect, getuser, getpwd1, runstate, timeout)
+    return await connectasync(host, port, hostconnect, getuser, getpwd1, runstate, timeout)
+
+# Log in to one device, find the prompt, turn off paging and run the command list on a single shell session
+async def runhostasync(hostconnect, commandlist, getuser, getpwd1, runstate, timeout):
+    host, port = splithost(hostconnect)
+    header_string = runstate['header_string']
+    timings = runstate['timings']
+
+    async with runstate['semaphore']:
+        # After two failed logins the devices not started yet are skipped, so the account is not locked out.
+        # A skipped device was not tried, so its circuit breaker is left as it was.
+        if runstate['abort']:
+            runstate['retries']['tried'].discard(hostconnect)
+            return
+
+        # Same file name as runcommands, with any :port turned into -port so it stays a valid file name
+        outputfile = 'output/' + hostconnect.replace(':', '-') + '.log'
+        hostoutput = open(outputfile, 'w')
+        hostoutput.write(header_string)
+        hostoutput.write('-' * len(header_string) + '\n')
+
+        try:
+            conn = await loginasync(host, port, hostconnect, getuser, getpwd1, runstate, timeout)
+            if conn is None:
+                runstate['retries']['tried'].discard(hostconnect)
+                hostoutput.close()
+                os.remove(outputfile)
+                return
+            async with conn:
+                with phase(timings, hostconnect, 'prompt'):
+                    process = await conn.create_process(term_type='vt100', term_size=(511, 24))
+                    prompt = await findprompt(process, timeout)
+
+                    # Same session setup netmiko does for cisco_ios, so output is not paged or wrapped
+                    for command in ['terminal length 0', 'terminal width 511']:
+                        process.stdin.write(command + '\n')
+                        await readuntilprompt(process, prompt, timeout)
+
+                for item in commandlist:
+                    with phase(timings, hostconnect, item):
+                        await runcommandasync(process, prompt, item, hostoutput, timeout)
+
+                process.stdin.write('exit\n')
+            runstate['successcount'] += 1
+
+        except (asyncssh.Error, OSError, asyncio.TimeoutError) as err:
+            # asyncssh errors such as a dropped connection are tried again, the same as in sync mode.  A failed login,
+            # or an SSH setup the device will never agree to, fails the same way every time and is not.
+            final = isinstance(err, (asyncssh.PermissionDenied, asyncssh.HostKeyNotVerifiable, asyncssh.KeyExchangeFailed,
+                                     asyncssh.ProtocolNotSupported, asyncssh.IllegalUserName))
+            if final or not retrylater(runstate['retries'], hostconnect, err, TRANSIENT + (asyncssh.Error, asyncio.TimeoutError)):
+                errorentry = (f"Connection Error: {hostconnect} - {err}\n")
+                print(errorentry)
+                runstate['errorlog'].write(errorentry)
+                runstate['errorlog'].write('-' * len(header_string) + '\n')
+                runstate['errorcount'] += 1
+
+            # This is for auth failure and will stop the run so to not lock out the users account
+            if isinstance(err, asyncssh.PermissionDenied):
+                runstate['autherror'] += 1
+                if runstate['autherror'] == 2:
+                    runstate['abort'] = True
+                    print('We have had two authentication errors.\n')
+                    print('\nPlease re-run and enter check password.\nPlease check log for any other errors.\n...skipping the rest of the devices.')
+                elif runstate['autherror'] == 1:
+                    print('...first authentication error, continuing...\n')
+
+        hostoutput.close()
+
+# Drop the echoed command and the trailing prompt from the raw shell output, the same as send_command does
+def striplines(output, command, prompt):
+    lines = output.replace('\r', '').split('\n')
+    if lines and lines[0].strip().endswith(command):
+        lines = lines[1:]
+    if lines and lines[-1].strip() == prompt:
+        lines = lines[:-1]
+    return '\n'.join(lines)
+
+# The async version of runcommand - sends one command on the open shell and writes the output as it comes back
+async def runcommandasync(process, prompt, command, hostoutput, timeout):
+    print(f'Running {command}\n')
+    hostoutput.write('\n' + '-' * 20 + '\n')
+    hostoutput.write(command + '\n')
+    process.stdin.write(command + '\n')
+    output = await readuntilprompt(process, prompt, timeout)
+    hostoutput.write(striplines(output, command, prompt))
+    hostoutput.flush()
 
 # Main section of script
 if __name__ == '__main__':
@@ -169,5 +481,9 @@ if __name__ == '__main__':
     welcome()
     getarg()
     userdata()
-    runcommands(datafile, commandfile, getuser, getpwd1, errorcount, successcount)
+    with profiled('demo1-4', profile):
+        if asyncmode:
+            asyncio.run(runcommandsasync(datafile, commandfile, getuser, getpwd1, errorcount, successcount, sessions))
+        else:
+            runcommands(datafile, commandfile, getuser, getpwd1, errorcount, successcount)
 
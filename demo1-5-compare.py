@@ -0,0 +1,215 @@
+import os
+import sys
+from datetime import datetime
+from signal import signal, SIGINT
+import hashlib
+import re
+
+
+# Signal handler to watch for ctrl-break - and if entered to exit the script.
+def handler(signal_received, frame):
+    os.system('cls' if os.name == 'nt' else 'clear')
+    print('\n\nBreak detected, exiting gracefully.\n')
+    print('Have a nice day!\n\n')
+    exit(0)
+
+# Clear the screen and print welcome banner
+def welcome():
+    os.system('cls' if os.name == 'nt' else 'clear')
+    print('***********************')
+    print('*  demo1-5-compare.py *')
+    print(f'* {dt_string} *')
+    print('***********************')
+    print('\n')
+
+# Get the current date and time, and then format at MM/DD/YY HH:MM:SS
+def timeinfo():
+    global dt_string, dt_save
+    now = datetime.now()
+    dt_string = now.strftime("%m/%d/%Y %H:%M:%S")
+    dt_save = now.strftime("  %b-%d  %H-%M")
+    print(dt_string)
+    return(dt_string)
+
+# Read commands passed from command line
+# Looking for two backup files, or two folders of backups, to compare - before and after
+def getarg(argv=sys.argv[1:]):
+    global before, after
+    # Checking to make sure both files were passed
+    if len(argv) != 2:
+        print('Please enter the before and after backup files, or two folders of backups, to compare.\n\n\tExample:\tdemo1-5-compare.py output/r1-backup.cfg after/r1-backup.cfg\n\t\t\tdemo1-5-compare.py before/ output/')
+        sys.exit()
+    before, after = argv
+    for item in argv:
+        if not os.path.exists(item):
+            print(f'An error occurred.\n\n{item} does not exist.')
+            sys.exit()
+
+    return before, after
+
+# Lines that change on every backup without the config changing, so they are left out of the compare
+SKIPLINES = re.compile(r'^(! Created on |Created on |-+$|Building configuration|Current configuration :|! Last configuration change|! NVRAM config last updated|!\s*$|end$)')
+
+# Read a backup file, dropping our header and the lines above.  Returns the config lines and a hash of them,
+# so two files with the same config can be skipped without building the section tree.
+def readconfig(configfile):
+    lines = []
+    digest = hashlib.sha1()
+    with open(configfile) as f:
+        for line in f:
+            line = line.rstrip()
+            if not line or SKIPLINES.match(line):
+                continue
+            lines.append(line)
+            digest.update(line.encode() + b'\n')
+    return lines, digest.hexdigest()
+
+# Build the section tree from the config lines.  Each line is a key in its parent's children, and anything
+# indented below it becomes its children.  Every section also carries a hash of all of its lines, so
+# sections that match between the two configs can be skipped without walking them.
+# A section is a dict of {'hash': ..., 'children': {line: section}}
+def parseconfig(lines):
+    root = {'children': {}}
+    # Stack of (indent, section) for the sections we are currently inside
+    stack = [(-1, root)]
+    banner = None
+
+    for line in lines:
+        # Banner text is not indented, so everything up to the closing delimiter goes under the banner line
+        if banner is not None:
+            if line.strip() != banner['delimiter']:
+                banner['section']['children'][line] = {'children': {}}
+            if banner['delimiter'] in line:
+                banner = None
+            continue
+        match = re.match(r'^banner \S+ (\^C|\S)', line)
+        if match:
+            while len(stack) > 1:
+                stack.pop()
+            section = {'children': {}}
+            root['children'][line] = section
+            if line.count(match.group(1)) < 2:
+                banner = {'section': section, 'delimiter': match.group(1)}
+            continue
+
+        indent = len(line) - len(line.lstrip())
+        while indent <= stack[-1][0]:
+            stack.pop()
+        section = {'children': {}}
+        stack[-1][1]['children'][line.strip()] = section
+        stack.append((indent, section))
+
+    hashsection(root)
+    return root
+
+# Work out the hash for a section from its own line and the hashes of its children
+def hashsection(section, line=''):
+    digest = hashlib.sha1(line.encode())
+    for childline, child in section['children'].items():
+        digest.update(hashsection(child, childline).encode())
+    section['hash'] = digest.hexdigest()
+    return section['hash']
+
+# The keyword a config line is known by, so a line that changed value is reported as changed
+# and not as one line removed and another added.  "description foo" is known by description,
+# "ip address 10.1.1.1 255.255.255.0" by ip address.
+def keyword(line):
+    words = line.split()
+    if words and words[0] == 'no':
+        words = words[1:]
+    if len(words) > 2 and words[0] in ('ip', 'ipv6', 'neighbor', 'switchport', 'spanning-tree', 'standby', 'vrrp'):
+        return ' '.join(words[:2])
+    return words[0] if words else line
+
+# Compare two sections and return the differences, each one a line of text starting with the path to the section.
+def diffsection(before, after, path):
+    changes = []
+    beforechildren = before['children']
+    afterchildren = after['children']
+
+    removed = [line for line in beforechildren if line not in afterchildren]
+    added = [line for line in afterchildren if line not in beforechildren]
+    prefix = ' > '.join(path) + ': ' if path else ''
+
+    # Pair up removed and added lines that share a keyword - those are values that changed
+    removedkeys = {}
+    for line in removed:
+        removedkeys.setdefault(keyword(line), []).append(line)
+    addedkeys = {}
+    for line in added:
+        addedkeys.setdefault(keyword(line), []).append(line)
+
+    for key, lines in removedkeys.items():
+        if len(lines) == 1 and len(addedkeys.get(key, [])) == 1 and not beforechildren[lines[0]]['children']:
+            newline = addedkeys.pop(key)[0]
+            oldvalue = lines[0][len(key):].strip()
+            newvalue = newline[len(key):].strip()
+            changes.append(f'{prefix}{key} changed ({oldvalue} -> {newvalue})')
+        else:
+            for line in lines:
+                changes.append(f'{prefix}removed {line}')
+    for lines in addedkeys.values():
+        for line in lines:
+            changes.append(f'{prefix}added {line}')
+
+    # Sections in both configs - only walk into the ones whose hash is different
+    for line, section in beforechildren.items():
+        if line in afterchildren and section['hash'] != afterchildren[line]['hash']:
+            changes.extend(diffsection(section, afterchildren[line], path + [line]))
+
+    return changes
+
+# Compare two backup files and return the list of differences, empty if they are the same
+def compareconfigs(beforefile, afterfile):
+    beforelines, beforehash = readconfig(beforefile)
+    afterlines, afterhash = readconfig(afterfile)
+    if beforehash == afterhash:
+        return []
+    return diffsection(parseconfig(beforelines), parseconfig(afterlines), [])
+
+# Compare the before and after - two files, or every backup file found in both folders
+def compare(before, after):
+    pairs = []
+    if os.path.isdir(before) and os.path.isdir(after):
+        afterfiles = set(os.listdir(after))
+        for item in sorted(os.listdir(before)):
+            if item.endswith('-backup.cfg') and item in afterfiles:
+                pairs.append((os.path.join(before, item), os.path.join(after, item)))
+            elif item.endswith('-backup.cfg'):
+                print(f'{item} is only in {before}, skipping.')
+    else:
+        pairs.append((before, after))
+
+    report = open('output/config-compare.txt', 'w')
+    header_string = (f'Created on {dt_string} \n')
+    report.write(header_string)
+    report.write('-' * len(header_string) + '\n')
+
+    changedcount = 0
+    for beforefile, afterfile in pairs:
+        changes = compareconfigs(beforefile, afterfile)
+        if not changes:
+            continue
+        changedcount += 1
+        title = f'{beforefile} -> {afterfile}'
+        print(f'\n{title}')
+        print('-' * len(title))
+        report.write(f'\n{title}\n')
+        report.write('-' * len(title) + '\n')
+        for change in changes:
+            print(f'\t{change}')
+            report.write(f'\t{change}\n')
+
+    print(f'\n\nCompared {len(pairs)} configs, {changedcount} had changes.  Report saved to output/config-compare.txt')
+    report.write(f'\n\nCompared {len(pairs)} configs, {changedcount} had changes.\n')
+    report.close()
+
+    return changedcount
+
+
+if __name__ == '__main__':
+    signal(SIGINT, handler)
+    timeinfo()
+    welcome()
+    getarg()
+    compare(before, after)
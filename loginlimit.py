@@ -0,0 +1,97 @@
+# Login rate limiting for the demo scripts.
+#
+# With many workers the scripts can log in to hundreds of devices at once, and every login is a request to the
+# TACACS/RADIUS servers behind them.  Each login here takes a token from a global bucket and from the bucket of the
+# AAA group the device is in, and waits until both have one.  The buckets refill at the group's rate, up to its
+# burst, so the logins run as fast as the AAA servers are set to take and no faster.
+#
+# The limits are read from logins.yml next to this file.  Devices are matched to a group by name, the first group
+# with a matching pattern wins, and devices in no group only count against the global limit.
+#
+#     logins = newlimiter()
+#     waitforlogin(logins, hostconnect)
+#     with ConnectHandler(**cisco1) as net_connect:
+import os
+import sys
+import time
+import asyncio
+import fnmatch
+import threading
+import yaml
+
+
+# The limits file, shared by the demo1 scripts and Demo2
+LOGINFILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'logins.yml')
+
+# Logins per second and burst for all devices together, when logins.yml does not set them
+LOGINRATE = 10
+LOGINBURST = 20
+
+
+# Make sure a rate read from logins.yml is a number of logins per second above 0, and stop the run if it is not
+def checkrate(name, rate):
+    if isinstance(rate, bool) or not isinstance(rate, (int, float)) or rate <= 0:
+        print(f'The {name} rate in logins.yml needs to be a number of logins per second above 0, not {rate}.\n')
+        sys.exit()
+    return rate
+
+# A token bucket, full to start with
+def newbucket(rate, burst):
+    return {'rate': float(rate), 'burst': float(burst), 'tokens': float(burst), 'last': time.monotonic()}
+
+# Read the limits and set up a bucket for the global limit and one for each AAA group
+def newlimiter(loginfile=LOGINFILE):
+    settings = {}
+    if os.path.exists(loginfile):
+        with open(loginfile) as f:
+            settings = yaml.safe_load(f) or {}
+
+    rate = checkrate('global', settings.get('rate', LOGINRATE))
+    groups = []
+    for name, group in (settings.get('groups') or {}).items():
+        grouprate = checkrate(f'{name} group', group.get('rate', rate))
+        groups.append({'name': name, 'devices': group.get('devices', []),
+                       'bucket': newbucket(grouprate, group.get('burst', grouprate))})
+
+    return {
+        'bucket': newbucket(rate, settings.get('burst', LOGINBURST)),
+        'groups': groups,
+        'lock': threading.Lock(),
+    }
+
+# The AAA group a device is in, or None
+def logingroup(limiter, hostconnect):
+    for group in limiter['groups']:
+        if any(fnmatch.fnmatch(hostconnect, pattern) for pattern in group['devices']):
+            return group
+    return None
+
+# The buckets a device logs in through - its AAA group's first, then the global one
+def loginbuckets(limiter, hostconnect):
+    group = logingroup(limiter, hostconnect)
+    return ([group['bucket']] if group else []) + [limiter['bucket']]
+
+# Take a token from the bucket and return how many seconds to wait for it.  A bucket can go below zero - those
+# are logins already promised a slot - so the waits queue up in order.
+def takebucket(limiter, bucket):
+    with limiter['lock']:
+        now = time.monotonic()
+        bucket['tokens'] = min(bucket['burst'], bucket['tokens'] + (now - bucket['last']) * bucket['rate'])
+        bucket['last'] = now
+        bucket['tokens'] -= 1
+        return max(0, -bucket['tokens'] / bucket['rate'])
+
+# Wait for the device's turn to log in.  The group's token is waited for first and the global one after, so a
+# device held back by its group does not take a global slot the other devices could be using in the meantime.
+def waitforlogin(limiter, hostconnect):
+    for bucket in loginbuckets(limiter, hostconnect):
+        wait = takebucket(limiter, bucket)
+        if wait > 0:
+            time.sleep(wait)
+
+# waitforlogin for the asyncio scripts, waiting on the event loop so the other devices carry on
+async def waitforloginasync(limiter, hostconnect):
+    for bucket in loginbuckets(limiter, hostconnect):
+        wait = takebucket(limiter, bucket)
+        if wait > 0:
+            await asyncio.sleep(wait)
@@ -0,0 +1,74 @@
+# Cached TextFSM parsing for the demo scripts.
+#
+# ntc_templates parse_output looks the command up in the template index and compiles the TextFSM
+# template on every call.  Here the template for each (platform, command) is found and read once per
+# process, and compiled once per thread, so parsing the same command for thousands of devices only
+# pays for the parse itself.
+#
+# Use it the same way as parse_output:
+#     from parsecache import parse_output
+#     show_int = parse_output(platform="cisco_ios", command="show interfaces", data=output)
+import io
+import threading
+import textfsm
+from textfsm import clitable
+from ntc_templates.parse import parse_output as ntc_parse_output, _get_template_dir
+
+
+# Template text for each (platform, command), or None if the index has more than one template for it
+TEMPLATES = {}
+TEMPLATE_LOCK = threading.Lock()
+
+# Compiled TextFSM objects hold their parse state, so each thread keeps its own
+PARSERS = threading.local()
+
+
+# Find the template for the platform and command in the ntc-templates index and read it in, once per process
+def gettemplate(platform, command):
+    key = (platform, command)
+    if key in TEMPLATES:
+        return TEMPLATES[key]
+
+    with TEMPLATE_LOCK:
+        if key not in TEMPLATES:
+            # CliTable keeps the index it reads at class level, so this only reads the index file the first time
+            cli_table = clitable.CliTable('index', _get_template_dir())
+            row_idx = cli_table.index.GetRowMatch({'Command': command, 'Platform': platform})
+            if not row_idx:
+                raise Exception(f'Unable to parse command "{command}" on platform {platform} - No template found')
+
+            templates = cli_table.index.index[row_idx]['Template']
+            # Commands that merge several templates are left to ntc_templates
+            if ':' in templates:
+                TEMPLATES[key] = None
+            else:
+                template_files = cli_table._TemplateNamesToFiles(templates)
+                try:
+                    TEMPLATES[key] = template_files[0].read()
+                finally:
+                    for f in template_files:
+                        f.close()
+
+    return TEMPLATES[key]
+
+# Get the compiled TextFSM for the platform and command, building it the first time this thread needs it
+def getparser(platform, command):
+    if not hasattr(PARSERS, 'cache'):
+        PARSERS.cache = {}
+
+    key = (platform, command)
+    if key not in PARSERS.cache:
+        template = gettemplate(platform, command)
+        PARSERS.cache[key] = None if template is None else textfsm.TextFSM(io.StringIO(template))
+
+    return PARSERS.cache[key]
+
+# Drop in replacement for ntc_templates parse_output, returning the same list of dictionaries
+def parse_output(platform=None, command=None, data=None):
+    fsm = getparser(platform, command)
+    if fsm is None:
+        return ntc_parse_output(platform=platform, command=command, data=data)
+
+    fsm.Reset()
+    header = [item.lower() for item in fsm.header]
+    return [dict(zip(header, record)) for record in fsm.ParseText(data)]
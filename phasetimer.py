@@ -0,0 +1,169 @@
+# Per-device, per-phase timing for the demo scripts.
+#
+# Each script keeps one timings dictionary for the run.  Every phase of the work on a device - the TCP connect,
+# the SSH login, finding the prompt, each command, parsing, writing files - is timed into it under the device
+# name.  At the end of the run reporttimings lists the slowest devices and phases, and saves the timings as
+# a JSON run summary and as a Prometheus textfile in logs/.
+#
+#     timings = newtimings('demo1-1')
+#     with timedconnect(timings, hostconnect, ConnectHandler, cisco1) as net_connect:
+#         with phase(timings, hostconnect, 'show run'):
+#             output = net_connect.send_command('show run')
+#     reporttimings(timings, errorcount, successcount)
+import os
+import json
+import time
+import socket
+import threading
+from contextlib import contextmanager
+from netmiko.ssh_exception import NetMikoTimeoutException
+from parsecache import parse_output
+
+
+# Start the timings for a run of the script
+def newtimings(script):
+    return {
+        'script': script,
+        'started': time.time(),
+        'clock': time.perf_counter(),
+        'devices': {},
+        'lock': threading.Lock(),
+    }
+
+# Add time to a phase of a device.  A phase that happens more than once on a device adds up.
+def addtime(timings, device, name, seconds):
+    with timings['lock']:
+        phases = timings['devices'].setdefault(device, {})
+        phases[name] = phases.get(name, 0) + seconds
+
+# Time the block inside the with as a phase of the device, whether it finishes or raises
+@contextmanager
+def phase(timings, device, name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        addtime(timings, device, name, time.perf_counter() - start)
+
+# Connect to a device the same as ConnectHandler(**params), timing the TCP connect, the SSH login and
+# finding the prompt as phases of their own.  The TCP connection is made here and handed to netmiko.
+# Logging out is timed as well, both when the with block ends and when disconnect is called directly.
+def timedconnect(timings, device, connecthandler, params):
+    # The handler works out the host and port, so the socket goes wherever ConnectHandler would have connected
+    net_connect = connecthandler(**params, auto_connect=False)
+    with phase(timings, device, 'tcp connect'):
+        try:
+            sock = socket.create_connection((net_connect.host, net_connect.port), timeout=net_connect.conn_timeout)
+        except socket.timeout as err:
+            raise NetMikoTimeoutException(f'TCP connection to device timed-out: {net_connect.host}:{net_connect.port}') from err
+
+    net_connect.sock = sock
+    try:
+        with phase(timings, device, 'ssh login'):
+            net_connect.establish_connection()
+        with phase(timings, device, 'prompt'):
+            net_connect._try_session_preparation()
+    except Exception:
+        sock.close()
+        raise
+
+    # The session has the socket now - anything that opens another connection from these settings, like SCP, makes its own
+    net_connect.sock = None
+
+    # Closing the session waits on the device, so it is a phase too.  __exit__ calls disconnect, so this covers both.
+    disconnect = net_connect.disconnect
+    def timeddisconnect():
+        with phase(timings, device, 'logout'):
+            disconnect()
+    net_connect.disconnect = timeddisconnect
+    return net_connect
+
+# parse_output for a process pool, returning the parsed output and the seconds the parse took so it can be added to the device
+def timedparse(platform=None, command=None, data=None):
+    start = time.perf_counter()
+    parsed = parse_output(platform=platform, command=command, data=data)
+    return parsed, time.perf_counter() - start
+
+# Total seconds spent on each phase across every device, with the count and the slowest single device
+def phasetotals(timings):
+    totals = {}
+    for phases in timings['devices'].values():
+        for name, seconds in phases.items():
+            total = totals.setdefault(name, {'seconds': 0, 'devices': 0, 'max': 0})
+            total['seconds'] += seconds
+            total['devices'] += 1
+            total['max'] = max(total['max'], seconds)
+    return totals
+
+# Save the timings as a JSON run summary
+def writejson(timings, summary, jsonfile):
+    report = dict(summary)
+    report['devices'] = {device: {'seconds': sum(phases.values()), 'phases': phases} for device, phases in timings['devices'].items()}
+    report['phases'] = phasetotals(timings)
+    with open(jsonfile + '.part', 'w') as f:
+        json.dump(report, f, indent=2)
+    os.replace(jsonfile + '.part', jsonfile)
+
+# Escape a Prometheus label value
+def promlabel(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+# Save the timings in the Prometheus text format, for the node_exporter textfile collector.
+# Written to a temporary file and renamed, so the collector never reads half a file.
+def writeprometheus(timings, summary, promfile):
+    script = promlabel(timings['script'])
+    lines = [
+        '# HELP automation_run_seconds Wall clock time of the run.',
+        '# TYPE automation_run_seconds gauge',
+        f'automation_run_seconds{{script="{script}"}} {summary["seconds"]:.6f}',
+        '# HELP automation_run_timestamp_seconds When the run started.',
+        '# TYPE automation_run_timestamp_seconds gauge',
+        f'automation_run_timestamp_seconds{{script="{script}"}} {summary["started"]:.0f}',
+        '# HELP automation_run_devices Devices in the run, by result.',
+        '# TYPE automation_run_devices gauge',
+        f'automation_run_devices{{script="{script}",result="success"}} {summary["successcount"]}',
+        f'automation_run_devices{{script="{script}",result="error"}} {summary["errorcount"]}',
+        '# HELP automation_phase_seconds Time spent on each phase of each device.',
+        '# TYPE automation_phase_seconds gauge',
+    ]
+    for device, phases in sorted(timings['devices'].items()):
+        for name, seconds in sorted(phases.items()):
+            lines.append(f'automation_phase_seconds{{script="{script}",device="{promlabel(device)}",phase="{promlabel(name)}"}} {seconds:.6f}')
+    with open(promfile + '.part', 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    os.replace(promfile + '.part', promfile)
+
+# End of the run - print how it went with the slowest devices and phases, and save the JSON summary and Prometheus textfile
+def reporttimings(timings, errorcount, successcount, count=5, logdir='logs'):
+    seconds = time.perf_counter() - timings['clock']
+    summary = {
+        'script': timings['script'],
+        'started': timings['started'],
+        'seconds': seconds,
+        'errorcount': errorcount,
+        'successcount': successcount,
+    }
+
+    print(f'\nRun took {seconds:.1f}s for {len(timings["devices"])} devices - {successcount} succeeded, {errorcount} errors')
+    if errorcount >= 1:
+        print('Please check error log')
+
+    devices = sorted(timings['devices'].items(), key=lambda item: sum(item[1].values()), reverse=True)
+    if devices:
+        print('\nSlowest devices:')
+        for device, phases in devices[:count]:
+            slowest = sorted(phases.items(), key=lambda item: item[1], reverse=True)[:3]
+            print(f'\t{device:<30}{sum(phases.values()):>8.2f}s\t' + ', '.join(f'{name} {phasetime:.2f}s' for name, phasetime in slowest))
+
+        print('\nSlowest phases, across all devices:')
+        totals = sorted(phasetotals(timings).items(), key=lambda item: item[1]['seconds'], reverse=True)
+        for name, total in totals[:count]:
+            print(f'\t{name:<30}{total["seconds"]:>8.2f}s total\t{total["seconds"] / total["devices"]:.2f}s average\t{total["max"]:.2f}s slowest')
+
+    jsonfile = os.path.join(logdir, timings['script'] + '-timings.json')
+    promfile = os.path.join(logdir, timings['script'] + '-timings.prom')
+    writejson(timings, summary, jsonfile)
+    writeprometheus(timings, summary, promfile)
+    print(f'\nTimings saved to {jsonfile} and {promfile}\n')
+
+    return summary
@@ -0,0 +1,75 @@
+# Pre-flight reachability check for the demo scripts.
+#
+# A device that is down costs the full connect timeout before a script gives up on it and moves on.  preflight
+# opens a TCP connection to the SSH port of every device at the same time, with a short timeout, and splits the
+# list into the devices that answered and the ones that did not before any SSH work starts.  The dead devices
+# are reported and logged straight away, and only the live ones are handed on to the script.
+#
+#     devicelist, deadcount = preflight(devicelist, errorlog, header_string)
+#     errorcount += deadcount
+import socket
+from concurrent.futures import ThreadPoolExecutor
+
+
+# Seconds to wait for a device to answer on the SSH port
+PROBETIMEOUT = 3
+
+# Most devices probed at the same time
+PROBEWORKERS = 256
+
+# Split a device into host and port - devices are written host or host:port, port 22 if there is none
+def splithost(hostconnect):
+    if hostconnect.count(':') == 1:
+        host, port = hostconnect.split(':')
+        return host, int(port)
+    return hostconnect, 22
+
+# The host and port for a device's netmiko connection settings, so a device written host:port connects to that port
+def sshhost(hostconnect):
+    host, port = splithost(hostconnect)
+    return {'host': host, 'port': port}
+
+# Open a TCP connection to the SSH port of the device and close it again.
+# Returns None if the device answered, otherwise why it did not.
+def probehost(hostconnect, timeout=PROBETIMEOUT):
+    host, port = splithost(hostconnect)
+    try:
+        with socket.create_connection((host, port), timeout=timeout):
+            return None
+    except socket.timeout:
+        return f'no answer on port {port} within {timeout}s'
+    except ConnectionRefusedError:
+        return f'connection refused on port {port}'
+    except socket.gaierror as err:
+        return f'name lookup failed - {err}'
+    except OSError as err:
+        return f'{err}'
+
+# Probe every device at the same time.  Returns the devices that answered, in the order they were given,
+# and a list of (device, reason) for the ones that did not.
+def probehosts(devicelist, timeout=PROBETIMEOUT, workers=PROBEWORKERS):
+    if not devicelist:
+        return [], []
+    with ThreadPoolExecutor(max_workers=min(workers, len(devicelist))) as pool:
+        reasons = list(pool.map(lambda host: probehost(host, timeout), devicelist))
+
+    reachable = [host for host, reason in zip(devicelist, reasons) if reason is None]
+    unreachable = [(host, reason) for host, reason in zip(devicelist, reasons) if reason is not None]
+    return reachable, unreachable
+
+# Probe the devices, print and log the ones that did not answer, and return the ones that did with a count of the rest.
+# Called before any workers start, so the error log is written without a lock.
+def preflight(devicelist, errorlog, header_string, timeout=PROBETIMEOUT):
+    print(f'Checking {len(devicelist)} devices answer on SSH...\n')
+    reachable, unreachable = probehosts(devicelist, timeout)
+
+    for hostconnect, reason in unreachable:
+        errorentry = f'Unreachable: {hostconnect} - {reason}\n'
+        print(errorentry)
+        errorlog.write(errorentry)
+        errorlog.write('-' * len(header_string) + '\n')
+
+    if unreachable:
+        print(f'{len(unreachable)} of {len(devicelist)} devices did not answer and will be skipped\n')
+
+    return reachable, len(unreachable)
@@ -0,0 +1,81 @@
+# Profiling for the demo scripts, turned on with --profile.
+#
+# The work of the script runs under cProfile, and a sampler thread records the stack of every thread at the same
+# time, so the worker threads of the pools show up as well as the main thread.  Each run leaves two files in logs/:
+#     logs/<script>-<date>-<time>.pstats       python -m pstats, or snakeviz
+#     logs/<script>-<date>-<time>.collapsed    one stack per line with its sample count, for flamegraph.pl or speedscope
+#
+#     with profiled('demo1-1', profile):
+#         backupconfigs(...)
+#
+# Without --profile nothing here runs - profiled hands straight back to the script.
+# Work done in a process pool happens in other processes and is not in the profile, only the wait for it is.
+import os
+import sys
+import cProfile
+import pstats
+import threading
+from datetime import datetime
+from contextlib import contextmanager
+
+
+# How often the sampler records the stacks, in seconds
+SAMPLEINTERVAL = 0.01
+
+# Name a stack frame for the collapsed file - file:function
+def framename(frame):
+    code = frame.f_code
+    return f'{os.path.basename(code.co_filename)}:{code.co_name}'
+
+# Record the stack of every thread but this one until stop is set.  Each stack is counted under the name of
+# its thread, without the worker number, so all the workers of a pool add up to one tower in the flame graph.
+def sample(samples, stop):
+    me = threading.get_ident()
+    while not stop.wait(SAMPLEINTERVAL):
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == me:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(framename(frame))
+                frame = frame.f_back
+            threadname = names.get(ident, 'thread').rsplit('_', 1)[0]
+            key = ';'.join([threadname] + stack[::-1])
+            samples[key] = samples.get(key, 0) + 1
+
+# Save the stacks in the collapsed format - frames root first separated by ;, then the count
+def writecollapsed(samples, collapsedfile):
+    with open(collapsedfile, 'w') as f:
+        for stack, count in sorted(samples.items()):
+            f.write(f'{stack} {count}\n')
+
+# Run the block inside the with under the profilers when enabled, and save the profile to logs/ when it ends -
+# whether it finishes, raises or the script exits
+@contextmanager
+def profiled(script, enabled, count=15, logdir='logs'):
+    if not enabled:
+        yield
+        return
+
+    basename = os.path.join(logdir, f'{script}-{datetime.now().strftime("%Y%m%d-%H%M%S")}')
+    samples = {}
+    stop = threading.Event()
+    sampler = threading.Thread(target=sample, args=(samples, stop), name='profiler', daemon=True)
+    profile = cProfile.Profile()
+
+    sampler.start()
+    profile.enable()
+    try:
+        yield
+    finally:
+        profile.disable()
+        stop.set()
+        sampler.join()
+
+        profile.dump_stats(basename + '.pstats')
+        writecollapsed(samples, basename + '.collapsed')
+
+        print(f'\nTop {count} functions by cumulative time, main thread:')
+        pstats.Stats(profile).sort_stats('cumulative').print_stats(count)
+        print(f'Profile saved to {basename}.pstats and {basename}.collapsed\n')
@@ -0,0 +1,165 @@
+# Retries and a circuit breaker for the demo scripts.
+#
+# A device that fails with a transient error - a timeout, a refused or dropped connection - is put back in the
+# queue instead of being logged as an error straight away.  It is tried again once the rest of the devices have
+# had their turn, after an exponential backoff with jitter, up to MAXRETRIES more times.
+#
+# A device that is still failing at the end of the run counts against its circuit breaker, kept across runs in
+# logs/circuit-breaker.json.  After BREAKERFAILS runs in a row the breaker opens and the device is skipped until
+# BREAKERCOOLDOWN seconds have passed.  It is then tried again - one more failed run opens the breaker again
+# straight away, a good one closes it.  Only transient failures count, a device that answers but fails
+# authentication or a command is not down.  Delete the file to try every device again.
+#
+#     retries = newretries()
+#     devicelist, errors = readydevices(retries, devicelist, errorlog, header_string)
+#     for hosts in retryrounds(retries, devicelist):
+#         ... work on the hosts, and where a device fails:
+#         if not retrylater(retries, hostconnect, err):
+#             logerror(...)
+#     closebreaker(retries)
+import os
+import json
+import time
+import random
+import socket
+import threading
+from datetime import datetime
+from netmiko.ssh_exception import NetMikoTimeoutException
+from preflight import preflight
+
+
+# Errors worth trying again - the device or the path to it had a bad moment
+TRANSIENT = (NetMikoTimeoutException, TimeoutError, socket.timeout, ConnectionRefusedError, ConnectionResetError,
+             ConnectionAbortedError, BrokenPipeError, EOFError)
+
+# Times a device is tried again in one run after its first attempt
+MAXRETRIES = 3
+
+# Backoff before the first retry, doubled for each one after, in seconds
+BACKOFFBASE = 5
+BACKOFFMAX = 120
+
+# Where the circuit breakers are kept between runs
+BREAKERFILE = 'logs/circuit-breaker.json'
+
+# Runs in a row a device has to fail before it is skipped, and how long it is skipped for, in seconds
+BREAKERFAILS = 3
+BREAKERCOOLDOWN = 3600
+
+
+# Start the retries for a run, with the circuit breakers saved by the runs before it
+def newretries(breakerfile=BREAKERFILE):
+    try:
+        with open(breakerfile) as f:
+            breaker = json.load(f)
+    except (FileNotFoundError, ValueError):
+        breaker = {}
+
+    return {
+        'queue': {},
+        'attempts': {},
+        'devices': [],
+        'tried': set(),
+        'failed': set(),
+        'breaker': breaker,
+        'breakerfile': breakerfile,
+        'lock': threading.Lock(),
+    }
+
+# Seconds to wait before a retry - doubles with each attempt, and half of it is random so a batch of devices
+# that failed together does not come back at the same moment
+def backoff(attempt):
+    delay = min(BACKOFFMAX, BACKOFFBASE * 2 ** attempt)
+    return delay / 2 + random.uniform(0, delay / 2)
+
+# Skip the devices whose circuit breaker is open, then probe the rest.  Returns the devices to work on and the
+# number of errors for the ones skipped or not answering, which are logged here.
+def readydevices(retries, devicelist, errorlog, header_string):
+    now = time.time()
+    skipped = []
+    for hostconnect in devicelist:
+        entry = retries['breaker'].get(hostconnect)
+        if entry and entry.get('until', 0) > now:
+            until = datetime.fromtimestamp(entry['until']).strftime('%m/%d/%Y %H:%M:%S')
+            errorentry = f'Skipped: {hostconnect} - failed the last {entry["failures"]} runs, circuit breaker open until {until}\n'
+            print(errorentry)
+            errorlog.write(errorentry)
+            errorlog.write('-' * len(header_string) + '\n')
+            skipped.append(hostconnect)
+
+    devicelist = [hostconnect for hostconnect in devicelist if hostconnect not in skipped]
+    retries['devices'] = devicelist
+
+    # A device that does not answer the probe has failed for this run
+    reachable, deadcount = preflight(devicelist, errorlog, header_string)
+    retries['failed'].update(hostconnect for hostconnect in devicelist if hostconnect not in reachable)
+
+    return reachable, len(skipped) + deadcount
+
+# Queue the device to be tried again if the error is transient and it has retries left.  Returns True if it was
+# queued, False if the failure is final and should be logged.  transient is the errors to count as transient.
+def retrylater(retries, hostconnect, err, transient=TRANSIENT):
+    if not isinstance(err, transient):
+        return False
+
+    with retries['lock']:
+        attempt = retries['attempts'].get(hostconnect, 0)
+        if attempt >= MAXRETRIES:
+            retries['failed'].add(hostconnect)
+            return False
+        delay = backoff(attempt)
+        retries['attempts'][hostconnect] = attempt + 1
+        retries['queue'][hostconnect] = time.monotonic() + delay
+
+    print(f'{hostconnect} - {err} - will try again in {delay:.0f}s, retry {attempt + 1} of {MAXRETRIES}\n')
+    return True
+
+# The devices to work on, a batch at a time - all of them first, then the devices queued for a retry, each batch
+# as soon as the first of them is due.  Anything queued while a batch runs comes round in a later batch.
+def retryrounds(retries, devicelist):
+    retries['tried'].update(devicelist)
+    yield devicelist
+
+    while retries['queue']:
+        wait = min(retries['queue'].values()) - time.monotonic()
+        if wait > 0:
+            time.sleep(wait)
+
+        now = time.monotonic()
+        with retries['lock']:
+            hosts = [hostconnect for hostconnect, due in retries['queue'].items() if due <= now]
+            for hostconnect in hosts:
+                del retries['queue'][hostconnect]
+
+        retries['tried'].update(hosts)
+        print(f'\nTrying {len(hosts)} devices again - {", ".join(hosts)}\n')
+        yield hosts
+
+# The devices one at a time in the same order as retryrounds, for the scripts that work on one device at a time
+def retryorder(retries, devicelist):
+    for hosts in retryrounds(retries, devicelist):
+        yield from hosts
+
+# End of the run - count a failed run against the breaker of every device that never got through, close the
+# breaker of the rest that were tried, and save the breakers for the next run.  A device the run never got to,
+# such as one after a rollout was stopped, is left as it was.
+def closebreaker(retries):
+    now = time.time()
+    breaker = retries['breaker']
+    for hostconnect in retries['devices']:
+        if hostconnect not in retries['failed']:
+            if hostconnect in retries['tried']:
+                breaker.pop(hostconnect, None)
+            continue
+
+        entry = breaker.setdefault(hostconnect, {'failures': 0})
+        entry['failures'] += 1
+        entry['last'] = now
+        if entry['failures'] >= BREAKERFAILS:
+            entry['until'] = now + BREAKERCOOLDOWN
+            print(f'{hostconnect} has failed {entry["failures"]} runs in a row - skipping it for the next {BREAKERCOOLDOWN // 60} minutes\n')
+
+    breakerfile = retries['breakerfile']
+    with open(breakerfile + '.part', 'w') as f:
+        json.dump(breaker, f, indent=2)
+    os.replace(breakerfile + '.part', breakerfile)
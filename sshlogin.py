@@ -0,0 +1,44 @@
+# SSH keys and unattended logins for the demo scripts.
+#
+# Set these in the environment to run a script without the username and password prompts, for example from cron:
+#     AUTOMATION_USER        username to log in with, the logged in user if not set
+#     AUTOMATION_PASSWORD    password to log in with
+#     AUTOMATION_KEYFILE     private key to log in with, instead of or as well as the password
+#
+# Either a password or a key file makes the run unattended.  With a key file the key is tried first, and the
+# password, if there is one, after it.
+import os
+import getpass
+
+
+# Environment variables for unattended runs
+USERVAR = 'AUTOMATION_USER'
+PASSWORDVAR = 'AUTOMATION_PASSWORD'
+KEYVAR = 'AUTOMATION_KEYFILE'
+
+
+# The username and password to use from the environment, or None when the run has to ask for them
+def envlogin():
+    password = os.environ.get(PASSWORDVAR)
+    if password is None and not os.environ.get(KEYVAR):
+        return None
+    return os.environ.get(USERVAR) or getpass.getuser(), password or ''
+
+# The key file to log in with, or None
+def keyfile():
+    path = os.environ.get(KEYVAR)
+    return os.path.expanduser(path) if path else None
+
+# Extra connection settings for netmiko to log in with the key file
+def sshkeys():
+    path = keyfile()
+    if path is None:
+        return {}
+    return {'use_keys': True, 'key_file': path}
+
+# Extra connection settings for asyncssh to log in with the key file
+def asynckeys():
+    path = keyfile()
+    if path is None:
+        return {}
+    return {'client_keys': [path]}